@@ -1,6 +1,6 @@
 try:
     from arsenic import connection
-    from structlog import wrap_logger
+    from structlog import BoundLogger, wrap_logger
 
     class NullLogger:
         def info(self, *args, **kw):
@@ -12,7 +12,8 @@ try:
         def msg(self, event):
             print(event)
 
-    logger = wrap_logger(NullLogger(), processors=[])
+    # the generic BoundLogger proxies custom methods like visit_url
+    logger = wrap_logger(NullLogger(), processors=[], wrapper_class=BoundLogger)
     connection.log = logger
 except ImportError:
     logger = None
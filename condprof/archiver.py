@@ -1,5 +1,8 @@
 """Maintains an archives directory given a profile
 """
+import bisect
+import contextlib
+import copy
 import io
 import sys
 import argparse
@@ -7,30 +10,258 @@ import tarfile
 import os
 import glob
 from datetime import date, timedelta
-import copy
 import json
+import hashlib
+import tempfile
 
 from condprof import logger
-from condprof.diffinfo import DiffInfo
-from condprof.util import check_exists, download_file, TASK_CLUSTER
-
-from condprof import progress
+from condprof import tracing
+from condprof import reporting
+from condprof.tracing import span
+from condprof.compaction import compact_databases, get_rules, get_size
+from condprof.diffinfo import DiffInfo, COMPARISONS
+from condprof.hashing import HashCache, hash_files, stream_digest
+from condprof.delta import (
+    DELTA_PREFIX,
+    BlockHasher,
+    changed_blocks,
+    get_block_size,
+    use_blocks,
+    worth_it,
+    write_delta,
+)
+from condprof.compression import (
+    open_archive,
+    open_incremental,
+    is_anchor,
+    is_isolated,
+    CODECS,
+    EXTENSIONS,
+    DEFAULT_LEVEL,
+)
+from condprof.manifest import (
+    Manifest,
+    MANIFEST_SUFFIX,
+    entry_from_tarinfo,
+    get_data_offset,
+    get_manifest_path,
+)
+from condprof.chunkstore import (
+    ChunkStore,
+    Snapshot,
+    snapshot_entry,
+    tarinfo_from_entry,
+)
+from condprof.retention import (
+    DEFAULT_WEEKLIES,
+    RetentionPolicy,
+    remove_files,
+    scan,
+)
+from condprof.util import check_exists, download_file, TASK_CLUSTER, ArchiveError
 
 
 def _b(data):
     return bytes(data, "utf8")
 
 
-def _tarinfo2mem(tar, tarinfo):
-    metadata = copy.copy(tarinfo)
-    try:
-        data = tar.extractfile(tarinfo)
-        if data is not None:
-            data = data.read()
-    except Exception:
-        data = None
+# size of the chunks read from archives when hashing or copying members
+BUFFER_SIZE = 1024 * 1024
+# digests of the profile files, kept between two runs
+HASH_CACHE = ".hp-hashes.json"
+STORAGES = ("tar", "chunks")
+
+
+def get_diff_name(name, date1, date2, extension=".tar.gz"):
+    """Returns the name of the diff tarball between two snapshots."""
+    date1 = date1.strftime("%Y-%m-%d")
+    date2 = date2.strftime("%Y-%m-%d")
+    return "%s-diff-%s-%s-hp%s" % (name, date1, date2, extension)
+
+
+def _tarinfo2digest(tar, tarinfo, buffer_size=BUFFER_SIZE):
+    """Returns the sha256 of a member's content, or None if it has none.
+
+    The content is streamed, so only buffer_size bytes are held at once.
+    """
+    if not tarinfo.isfile():
+        return None
+    return stream_digest(tar.extractfile(tarinfo), buffer_size)
 
-    return metadata, data
+
+class _HashingReader(object):
+    """Wraps a file and hashes what's read from it.
+
+    When block_size is given, the digests of each block are computed too.
+    """
+
+    def __init__(self, fileobj, block_size=None):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+        self.blocks = None
+        if block_size is not None:
+            self.blocks = BlockHasher(block_size)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        if self.blocks is not None:
+            self.blocks.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def block_digests(self):
+        if self.blocks is None:
+            return None
+        return [self.blocks.block_size, self.blocks.finish()]
+
+
+def _segments(manifest):
+    """Returns the runs of gzip members of an incremental archive that hold
+    whole files, by name of their first file.
+
+    Runs are (start, end, frames, entries) tuples, where start and end are
+    offsets in the tar stream and frames (compressed offset, compressed
+    size, size) tuples.
+    """
+    entries = sorted(manifest, key=lambda entry: entry.offset)
+    offsets = [entry.offset for entry in entries]
+    boundaries = set(offsets)
+    boundaries.add(manifest.info["end"])
+    frames = manifest.info["frames"]
+    segments = {}
+    current = []
+    for i, (start, compressed) in enumerate(frames):
+        if i + 1 == len(frames):
+            # the end of archive marker
+            break
+        next_start, next_compressed = frames[i + 1]
+        if not current:
+            if start not in boundaries:
+                continue
+            segment_start = start
+        current.append((compressed, next_compressed - compressed, next_start - start))
+        if next_start not in boundaries:
+            continue
+        first = bisect.bisect_left(offsets, segment_start)
+        last = bisect.bisect_left(offsets, next_start)
+        if last > first:
+            run = entries[first:last]
+            segments[run[0].name] = (segment_start, next_start, current, run)
+        current = []
+    return segments
+
+
+class _Tee(object):
+    """Wraps a file and copies what's read from it in another tarball, as
+    the content of tarinfo.
+
+    close() has to be called once tarinfo.size bytes have been read.
+    """
+
+    def __init__(self, fileobj, tar, tarinfo):
+        self.fileobj = fileobj
+        self.tar = tar
+        self.size = tarinfo.size
+        tarinfo = copy.copy(tarinfo)
+        buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+        tar.fileobj.write(buf)
+        tar.offset += len(buf)
+        tar.members.append(tarinfo)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.tar.fileobj.write(data)
+        return data
+
+    def close(self):
+        blocks, remainder = divmod(self.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.tar.offset += blocks * tarfile.BLOCKSIZE
+
+
+class _DiffWriter(object):
+    """Writes the diff with a previous manifest while the archive is
+    written.
+
+    Files known to be new or changed before they are read are copied to
+    the diff as they are read for the archive. Deltas need the block
+    digests of the new content, so databases that changed are read again.
+    """
+
+    def __init__(self, archiver, path, tar, previous):
+        self.archiver = archiver
+        self.path = path
+        self.tar = tar
+        self.previous = previous
+        self.info = DiffInfo(archiver.comparison)
+        self._seen = set()
+
+    def _changed(self, entry):
+        if entry.name not in self.previous:
+            return True
+        return self.info.comparison.changed(self.previous[entry.name], entry)
+
+    def _may_delta(self, entry):
+        if not self.archiver.delta or entry.name not in self.previous:
+            return False
+        old = self.previous[entry.name]
+        if old.blocks is None or old.mode != entry.mode:
+            return False
+        return use_blocks(entry.name, entry.size)
+
+    def reader(self, fileobj, tarinfo, digest=None):
+        """Returns what the archive should read fileobj through.
+
+        digest is the one of the content, if known before reading it.
+        """
+        entry = entry_from_tarinfo(tarinfo, digest)
+        if not self._changed(entry) or self._may_delta(entry):
+            return fileobj
+        return _Tee(fileobj, self.tar, tarinfo)
+
+    def add(self, entry, path, tarinfo=None, reader=None):
+        """Records a member of the archive in the diff, once it's written."""
+        self._seen.add(entry.name)
+        new = entry.name not in self.previous
+        if isinstance(reader, _Tee):
+            reader.close()
+        elif not self._changed(entry):
+            return
+        else:
+            if tarinfo is None:
+                tarinfo = self.tar.gettarinfo(path, entry.name)
+            if not tarinfo.isfile():
+                self.tar.addfile(tarinfo)
+            else:
+                old = None if new else self.previous[entry.name]
+                blocks = None
+                if old is not None:
+                    blocks = self.archiver._delta_blocks(old, entry)
+                with open(path, "rb") as f:
+                    if blocks is not None:
+                        self.archiver._add_delta(self.tar, f, entry, blocks)
+                        self.info.add_delta(entry.name, entry.size, entry.digest)
+                        return
+                    self.tar.addfile(tarinfo, f)
+        if new:
+            self.info.add_new(entry.name, entry.size, entry.digest)
+        else:
+            self.info.add_changed(entry.name, entry.size, entry.digest)
+
+    def finish(self):
+        """Records the deleted files and adds the diff info."""
+        for entry in self.previous:
+            if entry.name not in self._seen:
+                self.info.add_deleted(entry.name)
+        data = self.info.dump()
+        tarinfo = tarfile.TarInfo(name="diffinfo")
+        tarinfo.size = len(data)
+        self.tar.addfile(tarinfo, fileobj=io.BytesIO(data))
 
 
 class Archiver(object):
@@ -41,6 +272,19 @@ class Archiver(object):
         pem_file=None,
         pem_password=None,
         archives_server=None,
+        codec="gz",
+        compress_level=DEFAULT_LEVEL,
+        workers=1,
+        buffer_size=BUFFER_SIZE,
+        comparison="exact",
+        delta=False,
+        storage="tar",
+        includes=(),
+        excludes=(),
+        compact=False,
+        seekable=False,
+        retention=None,
+        incremental=False,
     ):
         self.archives_server = archives_server
         self.profile_dir = profile_dir
@@ -51,60 +295,391 @@ class Archiver(object):
         self.profile_name = self.metadata["name"]
         self.pem_file = pem_file
         self.pem_password = pem_password
+        self.codec = codec
+        self.extension = EXTENSIONS[codec]
+        self.compress_level = compress_level
+        self.workers = workers
+        self.buffer_size = buffer_size
+        if comparison not in COMPARISONS:
+            raise ValueError("Unknown comparison %r" % comparison)
+        self.comparison = comparison
+        self.delta = delta
+        if storage not in STORAGES:
+            raise ValueError("Unknown storage %r" % storage)
+        self.storage = storage
+        self.chunks = None
+        if storage == "chunks":
+            self.chunks = ChunkStore(os.path.join(archives_dir, "chunks"))
+        self.rules = get_rules(self.profile_name, includes, excludes)
+        self.compact = compact
+        self._excluded = []
+        if seekable and codec != "gz":
+            raise ValueError("Only gz archives can be seekable")
+        self.seekable = seekable
+        self.retention = retention
+        if incremental and codec != "gz":
+            raise ValueError("Only gz archives can be incremental")
+        self.incremental = incremental
 
-    def _strftime(self, date, template="-%Y-%m-%d-hp.tar.gz"):
+    def _strftime(self, date, template=None):
+        if template is None:
+            template = "-%Y-%m-%d-hp" + self.extension
         return date.strftime(self.profile_name + template)
 
     def _get_archive_path(self, when):
         archive = self._strftime(when)
         return os.path.join(self.archives_dir, archive), archive
 
+    def _get_snapshot_path(self, when):
+        snapshot = self._strftime(when, "-%Y-%m-%d-hp.snapshot")
+        return os.path.join(self.archives_dir, snapshot)
+
     def _get_diff_path(self, date1, date2):
-        date1 = date1.strftime("%Y-%m-%d")
-        date2 = date2.strftime("%Y-%m-%d")
-        arcname = self.profile_name + "-diff-%s-%s-hp.tar.gz" % (date1, date2)
+        arcname = get_diff_name(self.profile_name, date1, date2, self.extension)
         return os.path.join(self.archives_dir, arcname)
 
-    def create_archive(self, when, iterator=None):
-        if iterator is None:
+    def _hash_profile(self):
+        """Hashes the profile files in a pool of threads.
+
+        Returns a {arcname: (size, mtime, digest)} mapping. Digests of
+        files that did not change since the last run are read from a
+        cache stored in the profile.
+        """
+        with span("hash_profile") as s:
+            files = [
+                (name, path) for path, name in self._walk() if os.path.isfile(path)
+            ]
+            cache = HashCache(os.path.join(self.profile_dir, HASH_CACHE))
+            digests = hash_files(files, cache, self.workers, self.buffer_size)
+            cache.prune(digests)
+            cache.save()
+            s.add(files=len(files))
+        return digests
+
+    def _walk(self):
+        """Returns the (path, arcname) of everything in the profile.
+
+        Directories come before their content. Top-level dotfiles and
+        what the rules exclude are left out.
+        """
+        res = []
+        self._excluded = []
+
+        def _visit(path, arcname):
+            if self.rules.excluded(arcname):
+                self._excluded.append(path)
+                return
+            res.append((path, arcname))
+            if not os.path.isdir(path):
+                return
+            try:
+                names = sorted(os.listdir(path))
+            except FileNotFoundError:
+                return
+            for name in names:
+                _visit(os.path.join(path, name), arcname + "/" + name)
+
+        for filename in sorted(glob.glob(os.path.join(self.profile_dir, "*"))):
+            _visit(filename, os.path.basename(filename))
+        return res
+
+    def _compact(self):
+        """Compacts the databases, and reports what's left out."""
+        with span("compact") as s:
+            saved = compact_databases(self._walk(), vacuum=self.compact)
+            excluded = 0
+            for path in self._excluded:
+                try:
+                    excluded += get_size(path)
+                except FileNotFoundError:
+                    pass
+            s.add(bytes=saved + excluded, files=len(self._excluded))
+        msg = "Compaction saved %d bytes, %d files excluded (%d bytes)"
+        logger.msg(msg % (saved, len(self._excluded), excluded))
+        return saved + excluded
+
+    def _add(self, tar, path, arcname, manifest, digests=None, diff=None):
+        """Adds path to the tarball and records it in manifest.
+
+        When digests is None the content is not hashed. With a diff writer,
+        the file goes to the diff too if it changed.
+        """
+        tarinfo = tar.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # sockets and such
+            return
+        offset = tar.offset
+        digest = blocks = src = None
+        if tarinfo.isfile():
+            cached = None
+            if digests is not None:
+                cached = digests.get(arcname)
+            if cached and cached[:2] != (tarinfo.size, tarinfo.mtime):
+                # the file is new or changed since it was hashed
+                cached = None
+            with open(path, "rb") as f:
+                src = f
+                if diff is not None:
+                    src = diff.reader(f, tarinfo, cached[2] if cached else None)
+                if self.delta and use_blocks(arcname, tarinfo.size):
+                    block_size = get_block_size(f.read(100))
+                    f.seek(0)
+                    reader = _HashingReader(src, block_size)
+                    tar.addfile(tarinfo, reader)
+                    digest = reader.hexdigest()
+                    blocks = reader.block_digests()
+                elif cached:
+                    tar.addfile(tarinfo, src)
+                    digest = cached[2]
+                elif digests is not None:
+                    reader = _HashingReader(src)
+                    tar.addfile(tarinfo, reader)
+                    digest = reader.hexdigest()
+                else:
+                    tar.addfile(tarinfo, src)
+        else:
+            tar.addfile(tarinfo)
+        data_offset = get_data_offset(tar, tarinfo)
+        entry = entry_from_tarinfo(tarinfo, digest, offset, blocks, data_offset)
+        manifest.add(entry)
+        if diff is not None:
+            diff.add(entry, path, tarinfo, src)
+
+    def _get_previous(self, archive):
+        """Returns the latest archive and its manifest, if it can be reused."""
+        latest = os.path.join(
+            self.archives_dir, self.profile_name + "-latest" + self.extension
+        )
+        previous = os.path.realpath(latest)
+        if previous == os.path.realpath(archive) or not os.path.exists(previous):
+            return None, None
+        manifest = self._get_manifest(previous)
+        if "end" not in manifest.info:
+            return None, None
+        return previous, manifest
+
+    def _unchanged(self, tar, files, entries, digests):
+        """Tells if files are the same as the entries of a manifest."""
+        if len(files) < len(entries):
+            return False
+        for (path, arcname), entry in zip(files, entries):
+            if arcname != entry.name:
+                return False
+            try:
+                tarinfo = tar.gettarinfo(path, arcname)
+            except FileNotFoundError:
+                return False
+            if tarinfo is None:
+                return False
+            new = entry_from_tarinfo(tarinfo, entry.digest, entry.offset)
+            if new[:5] != entry[:5]:
+                return False
+            if tarinfo.isfile():
+                if digests is not None:
+                    cached = digests.get(arcname)
+                    if cached is None or cached[2] != entry.digest:
+                        return False
+            elif not tarinfo.isdir():
+                # the manifest does not tell where links point
+                return False
+        return True
 
-            def _files(tar):
-                files = glob.glob(os.path.join(self.profile_dir, "*"))
-                yield len(files)
-                for filename in files:
+    def _copy(self, tar, source, segment, manifest):
+        """Copies a run of gzip members from source. Returns its size."""
+        start, end, frames, entries = segment
+        offset = tar.offset
+        for compressed, compressed_size, size in frames:
+            source.seek(compressed)
+            tar.fileobj.copy(source.read(compressed_size), size)
+        tar.offset += end - start
+        for entry in entries:
+            shift = offset - start
+            entry = entry._replace(offset=entry.offset + shift)
+            if entry.data_offset is not None:
+                entry = entry._replace(data_offset=entry.data_offset + shift)
+            manifest.add(entry)
+        return end - start
+
+    def _profile_files(self, manifest, digests, diff=None):
+        """Returns an iterator for create_archive() adding the profile."""
+
+        def _files(tar):
+            tar.copybufsize = self.buffer_size
+            files = self._walk()
+            yield len(files)
+            for filename, arcname in files:
+                try:
+                    self._add(tar, filename, arcname, manifest, digests, diff)
+                    yield filename
+                except FileNotFoundError:
+                    # locks and such
+                    pass
+
+        return _files
+
+    def _incremental_files(self, archive, manifest, digests, diff=None):
+        """Returns an iterator for create_archive() that copies the gzip
+        members of unchanged files from the latest archive.
+        """
+        previous, previous_manifest = self._get_previous(archive)
+        segments = {}
+        if previous is not None:
+            segments = _segments(previous_manifest)
+
+        def _files(tar):
+            tar.copybufsize = self.buffer_size
+            writer = tar.fileobj
+            files = self._walk()
+            yield len(files)
+            reused = 0
+            cut = True
+            with contextlib.ExitStack() as stack:
+                if segments:
+                    source = stack.enter_context(open(previous, "rb"))
+                i = 0
+                while i < len(files):
+                    filename, arcname = files[i]
                     try:
-                        tar.add(filename, os.path.basename(filename))
+                        isolated = is_isolated(os.lstat(filename))
+                    except FileNotFoundError:
+                        isolated = False
+                    if isolated and not cut:
+                        writer.cut()
+                        cut = True
+                    segment = segments.get(arcname) if cut else None
+                    if segment is not None:
+                        entries = segment[3]
+                        stop = i + len(entries)
+                        run = files[i:stop]
+                        if self._unchanged(tar, run, entries, digests):
+                            reused += self._copy(tar, source, segment, manifest)
+                            for filename, arcname in run:
+                                if diff is not None:
+                                    diff.add(manifest[arcname], filename)
+                                yield filename
+                            i = stop
+                            continue
+                    try:
+                        self._add(tar, filename, arcname, manifest, digests, diff)
                         yield filename
                     except FileNotFoundError:
                         # locks and such
                         pass
+                    cut = isolated or is_anchor(arcname)
+                    if cut:
+                        writer.cut()
+                    i += 1
+            # the end of archive marker gets its own member
+            writer.cut()
+            manifest.info["end"] = tar.offset
+            logger.msg("Reused %d bytes of the latest archive" % reused)
+
+        return _files
+
+    @contextlib.contextmanager
+    def _diff_writer(self, when, previous):
+        """Yields a writer for the diff tarball from previous to when.
 
-            iterator = _files
+        The diff is written under a temporary name, and only shows up
+        once complete.
+        """
+        diff_archive = self._get_diff_path(when - timedelta(days=1), when)
+        part = diff_archive + ".part"
+        try:
+            with open_archive(
+                part,
+                "w",
+                codec=self.codec,
+                level=self.compress_level,
+                workers=self.workers,
+            ) as tar:
+                tar.copybufsize = self.buffer_size
+                diff = _DiffWriter(self, diff_archive, tar, previous)
+                yield diff
+                diff.finish()
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        os.replace(part, diff_archive)
+        logger.msg(str(diff.info))
 
+    def create_archive(self, when, iterator=None, manifest=None, previous=None):
+        """Creates an archive of the profile.
+
+        A custom iterator can provide the members instead. When it does,
+        the manifest is only written if one is passed. Otherwise, with the
+        manifest of the day before as previous, the diff with it is
+        written from the same reads of the profile.
+        """
         if isinstance(when, str):
             archive = when
         else:
             archive, __ = self._get_archive_path(when)
 
-        with tarfile.open(archive, "w:gz", dereference=True) as tar:
-            it = iterator(tar)
-            size = next(it)
-            with progress.Bar(expected_size=size) as bar:
-                for filename in it:
-                    if not TASK_CLUSTER:
-                        bar.show(bar.last_progress + 1)
+        incremental = self.incremental and iterator is None
+        profile = iterator is None
+        if profile:
+            self._compact()
+            manifest = Manifest()
+            digests = None
+            if self.comparison == "exact":
+                digests = self._hash_profile()
+
+        frames = [] if self.seekable or incremental else None
+        if incremental:
+            opener = open_incremental(
+                archive, frames, self.compress_level, self.workers
+            )
+        else:
+            opener = open_archive(
+                archive,
+                "w",
+                codec=self.codec,
+                level=self.compress_level,
+                workers=self.workers,
+                frames=frames,
+            )
+        diff = None
+        with span("create_archive", archive=os.path.basename(archive)) as s:
+            with contextlib.ExitStack() as stack:
+                if profile and previous is not None:
+                    diff = stack.enter_context(self._diff_writer(when, previous))
+                if incremental:
+                    iterator = self._incremental_files(archive, manifest, digests, diff)
+                elif profile:
+                    iterator = self._profile_files(manifest, digests, diff)
+                tar = stack.enter_context(opener)
+                it = iterator(tar)
+                size = next(it)
+                with reporting.task("archive", files=size) as task:
+                    done = 0
+                    for filename in it:
+                        task.add(files=1, bytes=tar.offset - done)
+                        done = tar.offset
+            s.add(files=size, bytes=os.path.getsize(archive))
+            if diff is not None:
+                s.add(diff_bytes=os.path.getsize(diff.path))
 
+        if manifest is not None:
+            if isinstance(when, date):
+                manifest.info["snapshot"] = when.strftime("%Y-%m-%d")
+            manifest.info["size"] = os.path.getsize(archive)
+            if frames is not None:
+                manifest.info["frames"] = frames
+            manifest.dump(get_manifest_path(archive))
         return archive
 
     def _update_symlinks(self, archive):
         archive_dir, archive_name = os.path.split(archive)
         archive_name = archive_name.split(".", 1)[0]
 
-        for suffix in (".tar.gz", ".tar.gz.sha256", ".tar.gz.asc"):
+        ext = self.extension
+        for suffix in (ext, ext + ".sha256", ext + ".asc", ext + MANIFEST_SUFFIX):
             path = os.path.join(
                 self.archives_dir, self.profile_name + "-latest" + suffix
             )
-            if os.path.exists(path):
+            if os.path.lexists(path):
                 os.remove(path)
             real = os.path.join(archive_dir, archive_name + suffix)
             if not os.path.exists(real):
@@ -120,60 +695,326 @@ class Archiver(object):
         if exists:
             download_file(url, target, check_file=True)
 
+    def _snapshot_entry(self, stat_tar, path, arcname, previous):
+        tarinfo = stat_tar.gettarinfo(path, arcname)
+        if tarinfo is None:
+            return None
+        if not tarinfo.isfile():
+            return snapshot_entry(tarinfo)
+
+        old = previous.get(arcname)
+        if (
+            old is not None
+            and (old["size"], old["mtime"]) == (tarinfo.size, tarinfo.mtime)
+            and all(chunk in self.chunks for chunk in old["chunks"])
+        ):
+            entry = dict(old)
+            entry.update(snapshot_entry(tarinfo, old["chunks"], old["digest"]))
+            return entry
+
+        eligible = self.delta and use_blocks(arcname, tarinfo.size)
+        with open(path, "rb") as f:
+            if eligible:
+                block_size = get_block_size(f.read(100))
+                f.seek(0)
+            chunks, digest = self.chunks.store_file(f)
+        entry = snapshot_entry(tarinfo, chunks, digest)
+        if eligible:
+            entry["block_size"] = block_size
+        return entry
+
+    def create_snapshot(self, when):
+        """Stores the profile in the chunk store.
+
+        Files that have the same size and mtime as in the previous day's
+        snapshot are not read again.
+        """
+        previous = {}
+        previous_path = self._get_snapshot_path(when - timedelta(days=1))
+        if os.path.exists(previous_path):
+            for entry in Snapshot.load(previous_path):
+                previous[entry["name"]] = entry
+
+        self._compact()
+        snapshot = Snapshot()
+        files = self._walk()
+        # only used to build TarInfo objects the way tarfile does
+        stat_tar = tarfile.open(fileobj=io.BytesIO(), mode="w", dereference=True)
+        path = self._get_snapshot_path(when)
+        # no gc until the snapshot references its chunks
+        with self.chunks.lock():
+            with stat_tar, reporting.task("snapshot", files=len(files)) as task:
+                for filename, arcname in files:
+                    task.add(files=1)
+                    try:
+                        entry = self._snapshot_entry(
+                            stat_tar, filename, arcname, previous
+                        )
+                    except FileNotFoundError:
+                        continue
+                    if entry is not None:
+                        snapshot.entries.append(entry)
+            snapshot.dump(path)
+        return path
+
+    def materialize(self, when, force=False):
+        """Returns the tarball of a snapshot, building it if needed.
+
+        With force, the tarball is rebuilt even if it exists, e.g. when
+        the snapshot was just rewritten.
+        """
+        archive, __ = self._get_archive_path(when)
+        if os.path.exists(archive) and not force:
+            return archive
+        snapshot = Snapshot.load(self._get_snapshot_path(when))
+        manifest = Manifest()
+
+        def _members(tar):
+            tar.copybufsize = self.buffer_size
+            yield len(snapshot)
+            for entry in snapshot:
+                tarinfo = tarinfo_from_entry(entry)
+                offset = tar.offset
+                blocks = None
+                if tarinfo.isfile():
+                    block_size = self.delta and entry.get("block_size") or None
+                    reader = _HashingReader(
+                        self.chunks.open(entry["chunks"]), block_size
+                    )
+                    tar.addfile(tarinfo, reader)
+                    if reader.hexdigest() != entry["digest"]:
+                        raise ArchiveError("Corrupted chunks for %r" % entry["name"])
+                    blocks = reader.block_digests()
+                else:
+                    tar.addfile(tarinfo)
+                data_offset = get_data_offset(tar, tarinfo)
+                manifest.add(
+                    entry_from_tarinfo(
+                        tarinfo, entry["digest"], offset, blocks, data_offset
+                    )
+                )
+                yield entry["name"]
+
+        logger.msg("Materializing %s" % archive)
+        return self.create_archive(when, _members, manifest)
+
+    def _prune_materialized(self, keep):
+        """Removes the tarballs that can be rebuilt from a snapshot."""
+        pattern = self.profile_name + "-*-hp.snapshot"
+        for path in glob.glob(os.path.join(self.archives_dir, pattern)):
+            archive = path[: -len(".snapshot")] + self.extension
+            if archive != keep and os.path.exists(archive):
+                os.remove(archive)
+
+    def _find_previous(self, when):
+        """Returns the archive of the day before, if it or its manifest
+        can be found locally or on the server.
+        """
+        previous, previous_fn = self._get_archive_path(when - timedelta(days=1))
+        previous_manifest = get_manifest_path(previous)
+        if not os.path.exists(previous) and not os.path.exists(previous_manifest):
+            # the manifest is all we need, the archive is a fallback
+            self._check_server(previous_fn + MANIFEST_SUFFIX, previous_manifest)
+            if not os.path.exists(previous_manifest):
+                self._check_server(previous_fn, previous)
+        if os.path.exists(previous) or os.path.exists(previous_manifest):
+            return previous
+        return None
+
     def update(self, when=None):
         if when is None:
             when = date.today()
-        archive = self.create_archive(when)
-
         # for now in task cluster we just generate the latest profile
+        previous = None
+        if not TASK_CLUSTER:
+            previous = self._find_previous(when)
+
+        if self.storage == "chunks":
+            with span("create_snapshot"):
+                self.create_snapshot(when)
+            archive = self.materialize(when, force=True)
+        else:
+            if previous is not None:
+                logger.msg("Creating the archive and the diff with the previous day")
+                previous_files = self._get_manifest(previous)
+                archive = self.create_archive(when, previous=previous_files)
+            else:
+                archive = self.create_archive(when)
+
         if TASK_CLUSTER:
             return
 
         logger.msg("Creating symlinks for %s..." % archive)
-        self._update_symlinks(archive)
-
+        with span("update_symlinks"):
+            self._update_symlinks(archive)
         logger.msg("Done.")
-        day_before = when - timedelta(days=1)
-        previous, previous_fn = self._get_archive_path(day_before)
-        if not os.path.exists(previous_fn):
-            self._check_server(previous_fn, previous)
 
-        if os.path.exists(previous):
+        if self.storage == "chunks" and previous is not None:
+            # materialized archives are diffed from their manifests
             logger.msg("Creating a diff tarball with the previous day")
-            self.create_diff(when, archive, previous)
+            with span("create_diff") as s:
+                diff_archive = self.create_diff(when, archive, previous)
+                s.add(bytes=os.path.getsize(diff_archive))
             logger.msg("Done.")
 
+        if self.storage == "chunks":
+            self._prune_materialized(archive)
+
+        if self.retention is not None:
+            self.squash(when, archive)
+            with span("collect_garbage") as s:
+                s.add(bytes=self.collect_garbage(when))
+
+    def squash(self, when, archive):
+        """Creates a diff to when from each snapshot the policy keeps.
+
+        The diffs are built from the manifests of the older snapshots, so
+        their archives are not needed. Returns the diffs.
+        """
+        archives, __ = scan(self.archives_dir, self.profile_name)
+        diffs = []
+        day_before = when - timedelta(days=1)
+        for day in sorted(self.retention.keep(archives)):
+            # the diff with the previous day is already there
+            if day >= day_before:
+                continue
+            previous, __ = self._get_archive_path(day)
+            if not os.path.exists(previous):
+                if not os.path.exists(get_manifest_path(previous)):
+                    continue
+            logger.msg("Squashing the diffs since %s" % day)
+            with span("squash_diff") as s:
+                diff_archive = self.create_diff(when, archive, previous, since=day)
+                s.add(bytes=os.path.getsize(diff_archive))
+            diffs.append(diff_archive)
+        return diffs
+
+    def collect_garbage(self, when):
+        """Removes what the retention policy does not keep.
+
+        That's the archives of the dates it drops, with their sidecars,
+        and the diffs that don't lead to when from a kept date. With the
+        chunk storage, unreferenced chunks go too. Returns the bytes freed.
+        """
+        archives, diffs = scan(self.archives_dir, self.profile_name)
+        keep = self.retention.keep(archives)
+        removed = []
+        for day, filenames in archives.items():
+            if day not in keep:
+                removed.extend(filenames)
+        for (since, day), filenames in diffs.items():
+            if day != when or since not in keep:
+                removed.extend(filenames)
+        freed = remove_files(self.archives_dir, removed)
+        if self.chunks is not None:
+            # the store can be shared by several profiles, and the snapshots
+            # being written are only listed once their writers are done
+            with self.chunks.lock(exclusive=True):
+                referenced = set()
+                pattern = os.path.join(self.archives_dir, "*-hp.snapshot")
+                for path in glob.glob(pattern):
+                    referenced.update(Snapshot.load(path).chunks())
+                freed += self.chunks.gc(referenced)
+        msg = "Removed %d files (%d bytes), kept %d snapshots"
+        logger.msg(msg % (len(removed), freed, len(keep)))
+        return freed
+
     def _read_tar(self, filename):
-        files = {}
-        with tarfile.open(filename, "r:gz") as tar:
+        """Builds the manifest of an archive by scanning it.
+
+        Payloads are hashed on the fly and never kept in memory.
+        """
+        manifest = Manifest()
+        with open_archive(filename) as tar:
             for tarinfo in tar:
-                files[tarinfo.name] = _tarinfo2mem(tar, tarinfo)
-        return files
+                digest = _tarinfo2digest(tar, tarinfo, self.buffer_size)
+                manifest.add(entry_from_tarinfo(tarinfo, digest))
+        return manifest
+
+    def _get_manifest(self, archive):
+        path = get_manifest_path(archive)
+        if os.path.exists(path):
+            return Manifest.load(path)
+        logger.msg("No manifest for %r, scanning the archive" % archive)
+        return self._read_tar(archive)
+
+    def _delta_blocks(self, old, new):
+        """Returns the blocks a delta from old to new would ship, or None
+        if it's not worth it.
+        """
+        if not self.delta or old.mode != new.mode or new.digest is None:
+            return None
+        blocks = changed_blocks(old.blocks, new.blocks)
+        if blocks is None or not worth_it(blocks, new.blocks[0], new.size):
+            return None
+        return blocks
+
+    def _add_delta(self, tar, src, entry, blocks):
+        """Adds the delta of a member to the diff tarball."""
+        with tempfile.SpooledTemporaryFile(max_size=self.buffer_size) as delta:
+            write_delta(
+                delta,
+                src,
+                entry.size,
+                entry.blocks[0],
+                blocks,
+                entry.mtime,
+                entry.digest,
+            )
+            tarinfo = tarfile.TarInfo(DELTA_PREFIX + entry.name)
+            tarinfo.size = delta.tell()
+            tarinfo.mtime = entry.mtime
+            delta.seek(0)
+            tar.addfile(tarinfo, delta)
+
+    def create_diff(self, when, current, previous, since=None):
+        """Creates the diff tarball from previous to current.
 
-    def create_diff(self, when, current, previous):
-        current_files = self._read_tar(current)
-        previous_files = self._read_tar(previous)
+        It goes from the day before when, or from since for squashed diffs.
+        """
+        current_files = self._get_manifest(current)
+        previous_files = self._get_manifest(previous)
         # build the diff info
-        diff_info = DiffInfo()
-        tarfiles = diff_info.update(current_files, previous_files)
-        day_before = when - timedelta(days=1)
-        diff_archive = self._get_diff_path(day_before, when)
+        diff_info = DiffInfo(self.comparison)
+        deltas = {}
+
+        def _use_delta(old, new):
+            blocks = self._delta_blocks(old, new)
+            if blocks is None:
+                return False
+            deltas[new.name] = blocks
+            return True
+
+        entries = diff_info.update(current_files, previous_files, _use_delta)
+        changed = set(entry.name for entry in entries)
+        if since is None:
+            since = when - timedelta(days=1)
+        diff_archive = self._get_diff_path(since, when)
         diff_data = diff_info.dump()
 
         def _arc(tar):
-            yield len(tarfiles) + 1
+            tar.copybufsize = self.buffer_size
+            yield len(changed) + 1
 
             diff_info = tarfile.TarInfo(name="diffinfo")
             diff_info.size = len(diff_data)
             tar.addfile(diff_info, fileobj=io.BytesIO(diff_data))
             yield diff_info
 
-            for info, data in tarfiles:
-                if data is not None:
-                    tar.addfile(info, fileobj=io.BytesIO(data))
-                else:
-                    tar.addfile(info)
-                yield info
+            # the payloads are streamed from the current archive
+            with open_archive(current) as source:
+                for info in source:
+                    if info.name not in changed:
+                        continue
+                    if info.name in deltas:
+                        entry = current_files[info.name]
+                        blocks = deltas[info.name]
+                        self._add_delta(tar, source.extractfile(info), entry, blocks)
+                    elif info.isfile():
+                        tar.addfile(info, fileobj=source.extractfile(info))
+                    else:
+                        tar.addfile(info)
+                    yield info
 
         self.create_archive(diff_archive, _arc)
         logger.msg(str(diff_info))
@@ -197,6 +1038,89 @@ def main(args=sys.argv[1:]):
         type=str,
         default="http://condprof.dev.mozaws.net",
     )
+    parser.add_argument(
+        "--codec", help="Compression codec", choices=CODECS, default="gz"
+    )
+    parser.add_argument(
+        "--compress-level",
+        help="Compression level",
+        type=int,
+        default=DEFAULT_LEVEL,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of compression threads",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--buffer-size",
+        help="Size of the buffer used to stream archive members",
+        type=int,
+        default=BUFFER_SIZE,
+    )
+    parser.add_argument(
+        "--comparison",
+        help="How files are compared when building diffs",
+        choices=sorted(COMPARISONS),
+        default="exact",
+    )
+    parser.add_argument(
+        "--delta",
+        help="Ship block deltas of databases in diffs",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--include",
+        help="Keep the files matching that pattern, even if excluded",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--exclude",
+        help="Leave the files matching that pattern out of archives",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--compact",
+        help="Vacuum SQLite databases with many free pages before archiving",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--seekable",
+        help="Index gzip frames so archive members can be read on their own",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Copy the compressed files that did not change from the latest archive",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--trace", help="Write a Chrome trace of the phases there", type=str
+    )
+    parser.add_argument(
+        "--keep-dailies",
+        help="Prune the archives, keeping that many daily snapshots",
+        type=int,
+    )
+    parser.add_argument(
+        "--keep-weeklies",
+        help="Weekly snapshots kept on top of the daily ones, when pruning",
+        type=int,
+        default=DEFAULT_WEEKLIES,
+    )
+    parser.add_argument(
+        "--storage",
+        help="Keep full archives, or chunks and rebuild archives on demand",
+        choices=STORAGES,
+        default="tar",
+    )
     args = parser.parse_args(args=args)
     args.pem_password = bytes(args.pem_password, "utf8")
 
@@ -204,12 +1128,29 @@ def main(args=sys.argv[1:]):
         logger.msg("%r does not exists." % args.archives_dir)
         sys.exit(1)
 
+    retention = None
+    if args.keep_dailies is not None:
+        retention = RetentionPolicy(args.keep_dailies, args.keep_weeklies)
+
     archiver = Archiver(
         args.profile_dir,
         args.archives_dir,
         args.pem_file,
         args.pem_password,
         args.archives_server,
+        codec=args.codec,
+        compress_level=args.compress_level,
+        workers=args.workers,
+        buffer_size=args.buffer_size,
+        comparison=args.comparison,
+        delta=args.delta,
+        storage=args.storage,
+        includes=args.include,
+        excludes=args.exclude,
+        compact=args.compact,
+        seekable=args.seekable,
+        retention=retention,
+        incremental=args.incremental,
     )
 
     # the archive name is of the form
@@ -217,7 +1158,14 @@ def main(args=sys.argv[1:]):
     name = "profile-%(platform)s-%(name)s-%(age)s-" "%(version)s-%(customization)s.tgz"
     name = name % archiver.metadata
     when = os.path.join(args.archives_dir, name)
-    archiver.update(when)
+    if args.trace is not None:
+        tracer = tracing.enable()
+    try:
+        archiver.update(when)
+    finally:
+        if args.trace is not None:
+            tracer.export(args.trace)
+            logger.msg(tracer.summary())
 
 
 if __name__ == "__main__":
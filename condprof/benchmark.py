@@ -0,0 +1,320 @@
+"""Benchmarks of the archiving pipeline, on synthetic profiles.
+
+No browser or network is needed: a profile is generated with random
+files and SQLite databases, archived, churned like a day of browsing
+would, archived again, and every step is timed. Results are written as
+JSON so runs can be compared across commits::
+
+    cp-bench --output before.json
+    cp-bench --output after.json --compare before.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+from condprof import logger
+from condprof.archiver import Archiver, HASH_CACHE
+from condprof.client import apply_diff, extract_profile
+from condprof.diffinfo import DiffInfo
+
+
+RESULTS_VERSION = 1
+_WORDS = [b"places", b"cookie", b"session", b"cache", b"storage", b"prefs"]
+
+
+def _content(rand, size, compressible):
+    if rand.random() < compressible:
+        words = []
+        while len(words) * 7 < size:
+            words.append(rand.choice(_WORDS))
+        return b" ".join(words)[:size]
+    # repeated past the 32KB deflate window, so it does not compress
+    block_size = max(1, min(size, 64 * 1024))
+    block = rand.getrandbits(block_size * 8).to_bytes(block_size, "little")
+    return (block * (size // block_size + 1))[:size]
+
+
+def _size(rand, median_size, max_size):
+    # file sizes in a profile are roughly log-normal
+    return min(max_size, int(rand.lognormvariate(math.log(median_size), 1.5)))
+
+
+def _create_db(path, rand, rows):
+    conn = sqlite3.connect(path)
+    conn.execute("create table visits (id integer primary key, url text, ts int)")
+    conn.executemany(
+        "insert into visits (url, ts) values (?, ?)",
+        (("https://example.com/%d" % rand.getrandbits(32), i) for i in range(rows)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def generate_profile(
+    target,
+    files=2000,
+    dirs=50,
+    depth=3,
+    median_size=4 * 1024,
+    max_size=4 * 1024 * 1024,
+    compressible=0.5,
+    databases=4,
+    db_rows=20000,
+    seed=0,
+):
+    """Creates a synthetic profile in target.
+
+    Files are spread in dirs nested directories up to depth levels deep.
+    Their sizes follow a log-normal distribution around median_size, and
+    a compressible share of them contains text. Returns the profile
+    size in bytes.
+    """
+    rand = random.Random(seed)
+    paths = [target]
+    for i in range(dirs):
+        parent = rand.choice([p for p in paths if p.count(os.sep) < depth + 1])
+        paths.append(os.path.join(parent, "dir%d" % i))
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+    with open(os.path.join(target, ".hp.json"), "w") as f:
+        f.write(json.dumps({"name": "bench"}))
+    total = 0
+    for i in range(files):
+        size = _size(rand, median_size, max_size)
+        path = os.path.join(rand.choice(paths), "file%d.bin" % i)
+        with open(path, "wb") as f:
+            f.write(_content(rand, size, compressible))
+        total += size
+    for i in range(databases):
+        path = os.path.join(target, "db%d.sqlite" % i)
+        _create_db(path, rand, db_rows)
+        total += os.path.getsize(path)
+    return total
+
+
+def churn(profile, modified=0.05, new=0.01, deleted=0.01, db_updates=200, seed=1):
+    """Changes a profile like a day of browsing would."""
+    rand = random.Random(seed)
+    files = []
+    databases = []
+    for root, dirs, names in os.walk(profile):
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            if name.endswith(".sqlite"):
+                databases.append(path)
+            else:
+                files.append(path)
+    rand.shuffle(files)
+    count = len(files)
+    removed = int(count * deleted)
+    for path in files[:removed]:
+        os.remove(path)
+    for path in files[removed:][: int(count * modified)]:
+        with open(path, "ab") as f:
+            f.write(_content(rand, 1024, 0.5))
+    for i in range(int(count * new)):
+        path = os.path.join(profile, "new%d.bin" % i)
+        with open(path, "wb") as f:
+            f.write(_content(rand, 4096, 0.5))
+    for path in databases:
+        conn = sqlite3.connect(path)
+        for i in range(db_updates):
+            conn.execute(
+                "update visits set ts = ? where id = ?",
+                (rand.getrandbits(31), rand.randrange(1, 1000)),
+            )
+        conn.commit()
+        conn.close()
+
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """Times func(setup()) repeat times, setup not included.
+
+    With memory, one more run is done under tracemalloc to get the peak
+    of Python allocations.
+    """
+    timings = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    result = {
+        "seconds": timings,
+        "min": min(timings),
+        "median": statistics.median(timings),
+    }
+    if memory:
+        arg = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            func(arg)
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(__file__),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(work_dir, repeat=3, memory=True, workers=1, **profile_options):
+    """Runs all the benchmarks in work_dir. Returns the results."""
+    profile = os.path.join(work_dir, "profile")
+    archives = os.path.join(work_dir, "archives")
+    os.makedirs(archives)
+    size = generate_profile(profile, **profile_options)
+    archiver = Archiver(profile, archives, workers=workers)
+    day1, day2 = date(2019, 1, 1), date(2019, 1, 2)
+    old, __ = archiver._get_archive_path(day1)
+    new, __ = archiver._get_archive_path(day2)
+    results = {}
+
+    def _cold(arg=None):
+        # the digests of the previous run are not reused
+        cache = os.path.join(profile, HASH_CACHE)
+        if os.path.exists(cache):
+            os.remove(cache)
+
+    def _bench(name, func, setup=None):
+        logger.msg("Running %s" % name)
+        results[name] = measure(func, setup, repeat, memory)
+
+    _bench("create_archive", lambda arg: archiver.create_archive(day1), _cold)
+    _bench("read_tar", lambda arg: archiver._read_tar(old))
+
+    churn(profile)
+    archiver.create_archive(day2)
+    old_files = archiver._get_manifest(old)
+    new_files = archiver._get_manifest(new)
+    _bench("diffinfo_update", lambda arg: DiffInfo().update(new_files, old_files))
+    info = DiffInfo()
+    info.update(new_files, old_files)
+    data = info.dump()
+    _bench("diffinfo_dump", lambda arg: info.dump())
+    _bench("diffinfo_load", lambda arg: DiffInfo().load(data))
+    _bench("create_diff", lambda arg: archiver.create_diff(day2, new, old))
+    diff = archiver._get_diff_path(day1, day2)
+
+    def _extract(target):
+        with open(old, "rb") as f:
+            extract_profile(f, target)
+
+    def _target():
+        return tempfile.mkdtemp(dir=work_dir)
+
+    def _extracted():
+        target = _target()
+        _extract(target)
+        return target
+
+    _bench("extract_profile", _extract, _target)
+    _bench("apply_diff", lambda target: apply_diff(diff, target), _extracted)
+
+    return {
+        "version": RESULTS_VERSION,
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "profile": dict(profile_options, bytes=size),
+        "archive_size": os.path.getsize(old),
+        "diff_size": os.path.getsize(diff),
+        "results": results,
+    }
+
+
+def compare(current, previous):
+    """Returns a table of the median timings of two runs."""
+    lines = ["%-20s %10s %10s %8s" % ("benchmark", "before", "after", "ratio")]
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        lines.append(
+            "%-20s %10.3f %10.3f %7.2fx"
+            % (name, before["median"], result["median"], ratio)
+        )
+    return "\n".join(lines)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Archiving benchmarks")
+    parser.add_argument(
+        "--output", help="JSON results file", type=str, default="bench.json"
+    )
+    parser.add_argument(
+        "--compare", help="Previous results to compare with", type=str, default=None
+    )
+    parser.add_argument("--files", help="Number of files", type=int, default=2000)
+    parser.add_argument(
+        "--databases", help="Number of SQLite databases", type=int, default=4
+    )
+    parser.add_argument(
+        "--median-size", help="Median file size", type=int, default=4 * 1024
+    )
+    parser.add_argument("--seed", help="Profile generation seed", type=int, default=0)
+    parser.add_argument("--repeat", help="Runs per benchmark", type=int, default=3)
+    parser.add_argument(
+        "--workers", help="Number of compression threads", type=int, default=1
+    )
+    parser.add_argument(
+        "--no-memory",
+        help="Do not measure memory",
+        dest="memory",
+        action="store_false",
+        default=True,
+    )
+    args = parser.parse_args(args=args)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        results = run_suite(
+            work_dir,
+            repeat=args.repeat,
+            memory=args.memory,
+            workers=args.workers,
+            files=args.files,
+            databases=args.databases,
+            median_size=args.median_size,
+            seed=args.seed,
+        )
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output, "w") as f:
+        f.write(json.dumps(results, indent=2))
+    logger.msg("Results written in %s" % args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            logger.msg(compare(results, json.loads(f.read())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""On-disk cache for downloaded artifacts (nightlies, profile archives).
+
+Each artifact lives in its own directory. The cache is shared by every
+creator process running on the host:
+
+- each entry has a lock file: a process that reads an entry holds a
+  shared lock on it, and one that fills it holds an exclusive lock
+- the index (sizes and last access times) is updated under a global lock
+- when the cache grows past its budget, the least recently used entries
+  that nobody is using are removed
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+DEFAULT_ROOT = os.path.join(os.path.expanduser("~"), ".condprof-cache")
+_COMPLETE = ".complete"
+
+
+def _entry_name(key):
+    digest = hashlib.sha1(key.encode("utf8")).hexdigest()[:12]
+    return re.sub(r"[^A-Za-z0-9._-]", "_", key)[-48:] + "-" + digest
+
+
+def _get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            if not os.path.islink(full):
+                size += os.path.getsize(full)
+    return size
+
+
+@contextlib.contextmanager
+def _flock(path, operation):
+    with open(path, "a") as f:
+        fcntl.flock(f, operation)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CacheEntry(object):
+    def __init__(self, cache, key, lock_file):
+        self.cache = cache
+        self.key = key
+        self.name = _entry_name(key)
+        self.path = os.path.join(cache.root, self.name)
+        self._lock_file = lock_file
+
+    @property
+    def complete(self):
+        return os.path.exists(os.path.join(self.path, _COMPLETE))
+
+    def commit(self):
+        """Marks the entry as complete and lets other processes read it."""
+        with open(os.path.join(self.path, _COMPLETE), "w"):
+            pass
+        self.cache._touch(self, _get_size(self.path))
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+
+
+class ArtifactCache(object):
+    def __init__(self, root=None, max_bytes=None):
+        if root is None:
+            root = os.environ.get("CONDPROF_CACHE_DIR", DEFAULT_ROOT)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("CONDPROF_CACHE_SIZE", DEFAULT_MAX_BYTES))
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._index_file = os.path.join(root, "index.json")
+        self._global_lock = os.path.join(root, ".lock")
+
+    def _read_index(self):
+        if not os.path.exists(self._index_file):
+            return {}
+        with open(self._index_file) as f:
+            try:
+                return json.loads(f.read())
+            except ValueError:
+                return {}
+
+    def _write_index(self, index):
+        tmp = self._index_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(index))
+        os.replace(tmp, self._index_file)
+
+    def _touch(self, entry, size=None):
+        with _flock(self._global_lock, fcntl.LOCK_EX):
+            index = self._read_index()
+            info = index.setdefault(entry.name, {"key": entry.key, "size": 0})
+            if size is not None:
+                info["size"] = size
+            info["atime"] = time.time()
+            self._write_index(index)
+
+    @contextlib.contextmanager
+    def open(self, key, exclusive=False):
+        """Yields the CacheEntry for key, locked for the whole block.
+
+        The entry is read-locked when it's complete. Otherwise, or when
+        exclusive is true, it's write-locked until entry.commit() is
+        called, so only one process fills it. An entry that is left
+        without a commit is removed.
+        """
+        name = _entry_name(key)
+        with open(os.path.join(self.root, name + ".lock"), "a") as lock_file:
+            entry = CacheEntry(self, key, lock_file)
+            filling = False
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                if exclusive or not entry.complete:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    filling = True
+                    os.makedirs(entry.path, exist_ok=True)
+                yield entry
+            finally:
+                # never committed, so not in the index and never evicted
+                if filling and not entry.complete:
+                    shutil.rmtree(entry.path, True)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if entry.complete:
+            self._touch(entry)
+        self.evict()
+
+    def size(self):
+        return sum(info["size"] for info in self._read_index().values())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits.
+
+        Entries in use by any process are skipped. Returns the number of
+        bytes freed.
+        """
+        freed = 0
+        with _flock(self._global_lock, fcntl.LOCK_EX):
+            index = self._read_index()
+            total = sum(info["size"] for info in index.values())
+            by_age = sorted(index.items(), key=lambda item: item[1].get("atime", 0))
+            for name, info in by_age:
+                if total <= self.max_bytes:
+                    break
+                lock = os.path.join(self.root, name + ".lock")
+                with open(lock, "a") as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    try:
+                        shutil.rmtree(os.path.join(self.root, name), True)
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                total -= info["size"]
+                freed += info["size"]
+                del index[name]
+            self._write_index(index)
+        return freed
@@ -0,0 +1,240 @@
+"""Content-addressed storage for profile snapshots.
+
+Files are cut in content-defined chunks, so an insertion only changes the
+chunks around it, and every chunk is stored once under its sha256 in the
+chunks directory. A dated snapshot is a
+small JSON file listing the members of the profile and their chunks, from
+which a regular tarball can be rebuilt.
+
+The store can be shared by several creators. Writers hold a shared lock
+until their snapshot is on disk, and gc() runs under the exclusive one,
+so it never sees chunks that are about to be referenced.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import tarfile
+import tempfile
+import zlib
+
+from condprof.cache import _flock
+
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+BUFFER_SIZE = 1024 * 1024
+SNAPSHOT_VERSION = 1
+
+
+def _anchor():
+    # Chunks are cut right after a 3-byte anchor: a byte from each of three
+    # 7-byte sets. That's 343 anchors out of 16M so a cut every ~48KB past
+    # the minimum size. Unlike a rolling hash computed in Python, the
+    # search runs at regex engine speed. The sets only have to be stable
+    # over time.
+    rand = random.Random(0)
+    classes = []
+    for i in range(3):
+        chars = sorted(rand.sample(range(256), 7))
+        classes.append(b"[" + b"".join(b"\\x%02x" % c for c in chars) + b"]")
+    return re.compile(b"".join(classes))
+
+
+_ANCHOR = _anchor()
+
+
+def iter_chunks(fileobj, min_size=MIN_CHUNK, max_size=MAX_CHUNK):
+    """Yields the content-defined chunks of a stream."""
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        while not eof and len(buf) - pos < max_size:
+            data = fileobj.read(BUFFER_SIZE)
+            if not data:
+                eof = True
+            buf = buf[pos:] + data
+            pos = 0
+        available = len(buf) - pos
+        if available == 0:
+            return
+        if available <= min_size:
+            yield buf[pos:]
+            return
+        end = pos + min(available, max_size)
+        anchor = _ANCHOR.search(buf, pos + min_size, end)
+        if anchor is not None:
+            end = anchor.end()
+        yield buf[pos:end]
+        pos = end
+
+
+class ChunkReader(object):
+    """Reads a file back from its chunks."""
+
+    def __init__(self, store, chunks):
+        self.store = store
+        self._chunks = iter(chunks)
+        self._current = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        res = []
+        while size != 0:
+            current, start = self._current, self._pos
+            if start == len(current):
+                digest = next(self._chunks, None)
+                if digest is None:
+                    break
+                self._current, self._pos = self.store.get(digest), 0
+                continue
+            if size < 0:
+                end = len(current)
+            else:
+                end = min(len(current), start + size)
+                size -= end - start
+            res.append(current[start:end])
+            self._pos = end
+        return b"".join(res)
+
+
+class ChunkStore(object):
+    def __init__(self, root, level=6):
+        self.root = root
+        self.level = level
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self._lock_file = os.path.join(root, ".lock")
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def __iter__(self):
+        for prefix in os.listdir(self.root):
+            subdir = os.path.join(self.root, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for digest in os.listdir(subdir):
+                if not digest.endswith(".tmp"):
+                    yield digest
+
+    def lock(self, exclusive=False):
+        """Locks the store: shared to write a snapshot, exclusive for gc()."""
+        return _flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            # shows the chunk is still used, to anything looking at mtimes
+            os.utime(path)
+            return digest
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # several creators can share the store, so writes are atomic
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(data, self.level))
+        os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def store_file(self, fileobj):
+        """Stores a stream. Returns its chunks and its sha256."""
+        digest = hashlib.sha256()
+        chunks = []
+        for chunk in iter_chunks(fileobj):
+            digest.update(chunk)
+            chunks.append(self.put(chunk))
+        return chunks, digest.hexdigest()
+
+    def open(self, chunks):
+        return ChunkReader(self, chunks)
+
+    def gc(self, referenced):
+        """Removes the chunks that are not in referenced.
+
+        The caller holds the exclusive lock, taken before listing the
+        referenced chunks. Returns the number of bytes freed.
+        """
+        referenced = set(referenced)
+        freed = 0
+        for digest in list(self):
+            if digest in referenced:
+                continue
+            path = self._path(digest)
+            freed += os.path.getsize(path)
+            os.remove(path)
+        return freed
+
+
+_TARINFO_FIELDS = (
+    "name",
+    "size",
+    "mtime",
+    "mode",
+    "linkname",
+    "uid",
+    "gid",
+    "uname",
+    "gname",
+)
+
+
+def snapshot_entry(tarinfo, chunks=None, digest=None):
+    entry = dict((field, getattr(tarinfo, field)) for field in _TARINFO_FIELDS)
+    entry["type"] = tarinfo.type.decode("ascii")
+    entry["chunks"] = chunks or []
+    entry["digest"] = digest
+    return entry
+
+
+def tarinfo_from_entry(entry):
+    tarinfo = tarfile.TarInfo()
+    for field in _TARINFO_FIELDS:
+        setattr(tarinfo, field, entry[field])
+    tarinfo.type = entry["type"].encode("ascii")
+    return tarinfo
+
+
+class Snapshot(object):
+    """The members of a profile at a given date, as chunk lists."""
+
+    def __init__(self, entries=None):
+        self.entries = entries or []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def chunks(self):
+        for entry in self.entries:
+            for chunk in entry["chunks"]:
+                yield chunk
+
+    def dump(self, filename):
+        data = {"version": SNAPSHOT_VERSION, "entries": self.entries}
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(data))
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.loads(f.read())
+        if data.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version in %r" % filename)
+        return cls(data["entries"])
@@ -1,50 +1,269 @@
 # client for conditioned profiles
+import contextlib
 import os
-import tarfile
-import functools
+import shutil
+from datetime import datetime, timedelta
 
-from clint.textui import progress
-from condprof import logger
-from condprof.util import check_exists, download_file, TASK_CLUSTER
+from condprof import logger, reporting
+from condprof.tracing import span
+from condprof.archiver import get_diff_name
+from condprof.compression import EXTENSIONS, get_codec, open_archive, open_stream
+from condprof.clone import clone_profile
+from condprof.delta import DELTA_PREFIX, DeltaError, apply_delta
+from condprof.diffinfo import Change, DiffInfo, iter_changes
+from condprof.manifest import Manifest, MANIFEST_SUFFIX
+from condprof.seekable import extract_members, is_seekable
+from condprof.util import (
+    check_exists,
+    download_file,
+    stream_file,
+    ArchiveNotFound,
+    TASK_CLUSTER,
+)
 
 
 TC_LINK = (
     "https://index.taskcluster.net/v1/task/garbage.condprof/"
     "artifacts/public/today-%s.tgz"
 )
+# date of the snapshot a local profile was built from
+SNAPSHOT_FILE = ".hp-snapshot"
+# past that many days we don't even try to chain daily diffs
+MAX_CHAIN = 30
 
 
-def get_profile(args):
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def get_snapshot(profile):
+    path = os.path.join(profile, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        try:
+            return _parse_date(f.read().strip())
+        except ValueError:
+            return None
+
+
+def set_snapshot(profile, snapshot):
+    with open(os.path.join(profile, SNAPSHOT_FILE), "w") as f:
+        f.write(snapshot.strftime("%Y-%m-%d"))
+
+
+def apply_diff(archive, profile):
+    """Applies a diff tarball to a profile directory.
+
+    The diff tarball holds the new and changed files, the deltas of the
+    patched ones and a diffinfo member, first or last. The diffinfo is
+    streamed and only the deleted names are kept. Returns a DiffInfo
+    counting the changes.
+    """
+    diff_info = DiffInfo()
+    deleted = []
+    with open_archive(archive, "r") as tar, reporting.task("patch") as task:
+        for tarinfo in tar:
+            task.add(files=1, bytes=tarinfo.size)
+            if tarinfo.name == "diffinfo":
+                for entry in iter_changes(tar.extractfile(tarinfo)):
+                    diff_info.count(entry.change)
+                    if entry.change == Change.DELETED:
+                        deleted.append(entry.name)
+            elif tarinfo.name.startswith(DELTA_PREFIX):
+                path = os.path.join(profile, tarinfo.name.split("/", 1)[1])
+                apply_delta(tar.extractfile(tarinfo), path)
+            else:
+                tar.extract(tarinfo, profile)
+
+    for name in deleted:
+        path = os.path.join(profile, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    return diff_info
+
+
+@contextlib.contextmanager
+def _download_dir(args, url):
+    """Yields the directory where url should be downloaded.
+
+    When args.cache is set, every url gets its own entry in the shared
+    artifact cache, refreshed through its ETag.
+    """
+    cache = getattr(args, "cache", None)
+    if cache is None:
+        yield args.archives_dir
+        return
+    with cache.open(url, exclusive=True) as entry:
+        yield entry.path
+        entry.commit()
+
+
+def _extension(args):
+    # the codec of the archives on the server
+    return EXTENSIONS[getattr(args, "codec", "gz")]
+
+
+def extract_profile(fileobj, profile, codec="gz"):
+    """Extracts a profile tarball read from a stream, member by member."""
+    with span("extract_profile") as s, reporting.task("extract") as task:
+        with open_stream(fileobj, codec) as tar:
+            for tarinfo in tar:
+                tar.extract(tarinfo, profile)
+                s.add(bytes=tarinfo.size, files=1)
+                task.add(files=1, bytes=tarinfo.size)
+
+
+def _get_chain(args, snapshot, latest):
+    """Returns the diffs from snapshot to latest and their total size.
+
+    Diffs are (url, snapshot reached) tuples. A squashed diff is used when
+    the server has one, otherwise the daily diffs are chained. Returns
+    None if one of them is missing.
+    """
+    behind = latest - snapshot
+    if behind > timedelta(days=1):
+        url = args.archives_server + "/%s" % get_diff_name(
+            args.scenarii, snapshot, latest, _extension(args)
+        )
+        exists, headers = check_exists(url)
+        if exists:
+            return [(url, latest)], int(headers.get("content-length", 0))
+    if behind > timedelta(days=MAX_CHAIN):
+        return None
+    diffs = []
+    size = 0
+    day = snapshot
+    while day < latest:
+        next_day = day + timedelta(days=1)
+        name = get_diff_name(args.scenarii, day, next_day, _extension(args))
+        url = args.archives_server + "/%s" % name
+        exists, headers = check_exists(url)
+        if not exists:
+            logger.msg("Missing diff %r" % name)
+            return None
+        diffs.append((url, next_day))
+        size += int(headers.get("content-length", 0))
+        day = next_day
+    return diffs, size
 
+
+def _catch_up(args, latest):
+    """Tries to bring the local profile to the latest snapshot using diffs.
+
+    Returns True if the profile is up to date.
+    """
+    snapshot = get_snapshot(args.profile)
+    if snapshot is None or "snapshot" not in latest.info:
+        return False
+    latest_snapshot = _parse_date(latest.info["snapshot"])
+    if snapshot == latest_snapshot:
+        logger.msg("Profile is up to date")
+        return True
+    if snapshot > latest_snapshot:
+        return False
+
+    chain = _get_chain(args, snapshot, latest_snapshot)
+    if chain is None:
+        return False
+    diffs, size = chain
+    full_size = latest.info.get("size")
+    if full_size is not None and size >= full_size:
+        logger.msg("Diffs are bigger than the full archive")
+        return False
+
+    logger.msg("Applying %d diff(s), %d bytes" % (len(diffs), size))
+    for url, day in diffs:
+        basename = url.split("/")[-1]
+        with _download_dir(args, url) as download_dir:
+            target = os.path.join(download_dir, basename)
+            archive = download_file(url, target=target, check_file=False)
+            try:
+                with span("apply_diff", files=1, bytes=os.path.getsize(archive)):
+                    diff_info = apply_diff(archive, args.profile)
+            except DeltaError:
+                logger.msg("Could not patch the profile with %r" % basename)
+                return False
+        logger.msg("%s %s" % (basename, diff_info))
+        # each step is recorded, so an interrupted chain can be resumed
+        set_snapshot(args.profile, day)
+
+    return True
+
+
+def _get_latest_manifest(args, basename):
+    url = args.archives_server + "/%s" % (basename + MANIFEST_SUFFIX)
+    exists, __ = check_exists(url)
+    if not exists:
+        return None
+    with _download_dir(args, url) as download_dir:
+        target = os.path.join(download_dir, basename + MANIFEST_SUFFIX)
+        return Manifest.load(download_file(url, target=target, check_file=False))
+
+
+def get_profile(args):
     # getting the latest archive from the server
+    latest = None
     if TASK_CLUSTER:
         url = TC_LINK % args.scenarii
         basename = "today-%s.tgz" % args.scenarii
     else:
-        basename = "%s-latest.tar.gz" % args.scenarii
+        basename = "%s-latest%s" % (args.scenarii, _extension(args))
         url = args.archives_server + "/%s" % basename
-    exists, __ = check_exists(url)
+        latest = _get_latest_manifest(args, basename)
+        if latest is not None and _catch_up(args, latest):
+            return args.profile
 
-    if not exists:
+    # members are extracted as the archive is downloaded, and the archive
+    # is kept in the archives dir (or the artifact cache) for the next time
+    try:
+        with _download_dir(args, url) as download_dir:
+            target = None
+            if getattr(args, "cache_archive", True):
+                target = os.path.join(download_dir, basename)
+            with stream_file(url, target=target) as stream:
+                extract_profile(stream, args.profile, get_codec(basename))
+    except ArchiveNotFound:
         return None
 
-    target = os.path.join(args.archives_dir, basename)
-    archive = download_file(url, target=target, check_file=False)
-    with tarfile.open(archive, "r:gz") as tar:
-        logger.msg("Checking the tarball content...")
-        size = len(list(tar))
-        with progress.Bar(expected_size=size) as bar:
-
-            def _extract(self, *args, **kw):
-                if not TASK_CLUSTER:
-                    bar.show(bar.last_progress + 1)
-                try:
-                    return self.old(*args, **kw)
-                finally:
-                    pass
-
-            tar.old = tar.extract
-            tar.extract = functools.partial(_extract, tar)
-            tar.extractall(args.profile)
+    if latest is not None and "snapshot" in latest.info:
+        set_snapshot(args.profile, _parse_date(latest.info["snapshot"]))
 
     return args.profile
+
+
+def get_profiles(args, targets):
+    """Gets the profile once in args.profile, then clones it in targets.
+
+    That's the "extract once, clone many" mode: args.profile is a template
+    kept up to date with diffs, and the targets, which must not exist, are
+    cheap copies of it. Returns the targets, or None when there's no
+    profile to get.
+    """
+    if get_profile(args) is None:
+        return None
+    with span("clone_profiles", profiles=len(targets)):
+        for target in targets:
+            clone_profile(args.profile, target)
+    return targets
+
+
+def get_files(args, names, target=None):
+    """Extracts some files of the latest archive in target.
+
+    Only the parts of the archive that hold them are downloaded, using
+    Range requests. Returns False when the archive is not seekable.
+    """
+    basename = "%s-latest%s" % (args.scenarii, _extension(args))
+    manifest = _get_latest_manifest(args, basename)
+    if not is_seekable(manifest):
+        return False
+    url = args.archives_server + "/%s" % basename
+    with span("get_files", files=len(names)) as s:
+        read = extract_members(url, manifest, names, target or args.profile)
+        s.add(bytes=read)
+    logger.msg("Extracted %d files, %d bytes read" % (len(names), read))
+    return True
@@ -0,0 +1,90 @@
+"""Cheap copies of profile directories.
+
+Files are cloned with copy-on-write reflinks when the filesystem has
+them (btrfs, XFS...). Otherwise read-only files are hard linked, since
+they can't be changed in place, and the others are copied. Nothing is
+read-only for root, so it never gets hard links.
+"""
+import errno
+import fcntl
+import os
+import shutil
+import stat
+
+from condprof import logger
+
+
+# _IOW(0x94, 9, int) in linux/fs.h
+FICLONE = 0x40049409
+# the filesystem, or the pair of files, can't do it
+_NO_REFLINK = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS)
+_NO_LINK = (errno.EXDEV, errno.EPERM, errno.EMLINK)
+_WRITE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+def _is_root():
+    return hasattr(os, "geteuid") and os.geteuid() == 0
+
+
+class Cloner(object):
+    """Clones files with the cheapest method that works.
+
+    A method that fails once is not tried again. The reflinked, linked
+    and copied counters tell how files were cloned.
+    """
+
+    def __init__(self, reflink=True, link=True):
+        self.reflink = reflink
+        self.link = link and not _is_root()
+        self.reflinked = self.linked = self.copied = 0
+
+    def __repr__(self):
+        msg = "%d files reflinked, %d linked, %d copied"
+        return msg % (self.reflinked, self.linked, self.copied)
+
+    def _reflink(self, src, dst):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in _NO_REFLINK:
+                raise
+            self.reflink = False
+            os.remove(dst)
+            return False
+        shutil.copystat(src, dst)
+        return True
+
+    def _link(self, src, dst):
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in _NO_LINK:
+                raise
+            self.link = False
+            return False
+        return True
+
+    def __call__(self, src, dst):
+        """Clones the src file to dst, copytree()'s copy_function style."""
+        if self.reflink and self._reflink(src, dst):
+            self.reflinked += 1
+        elif self.link and not os.stat(src).st_mode & _WRITE and self._link(src, dst):
+            self.linked += 1
+        else:
+            shutil.copy2(src, dst)
+            self.copied += 1
+        return dst
+
+    def clone(self, source, target):
+        """Clones the source directory to target, which must not exist."""
+        shutil.copytree(source, target, symlinks=True, copy_function=self)
+        return target
+
+
+def clone_profile(source, target):
+    """Clones a profile directory. Returns target."""
+    cloner = Cloner()
+    cloner.clone(source, target)
+    logger.msg("Cloned %r to %r: %s" % (source, target, cloner))
+    return target
@@ -0,0 +1,138 @@
+"""Shrinks a profile before it's archived.
+
+- files Firefox rebuilds on its own (caches, crash reports, locks) are
+  left out of archives by exclusion rules
+- SQLite databases get their WAL checkpointed and, when compaction is
+  on, are vacuumed if enough of their pages are free
+"""
+import fnmatch
+import os
+import sqlite3
+
+from condprof import logger
+
+
+# regenerated by Firefox, or only meaningful to a running instance
+DEFAULT_EXCLUDES = (
+    "cache2",
+    "startupCache",
+    "thumbnails",
+    "shader-cache",
+    "safebrowsing",
+    "OfflineCache",
+    "crashes",
+    "minidumps",
+    "saved-telemetry-pings",
+    "lock",
+    ".parentlock",
+    "parent.lock",
+    "*-wal",
+    "*-shm",
+    "*-journal",
+)
+# extra rules per scenario, as (includes, excludes)
+SCENARIO_RULES = {}
+DATABASE_PATTERNS = ("*.sqlite", "*.db")
+# databases are vacuumed past that share of free pages
+VACUUM_RATIO = 0.1
+
+
+class Rules(object):
+    """Include and exclude fnmatch patterns.
+
+    A pattern without a slash is matched against every path component,
+    one with slashes against the whole relative path. Includes win over
+    excludes.
+    """
+
+    def __init__(self, includes=(), excludes=DEFAULT_EXCLUDES):
+        self.includes = tuple(includes)
+        self.excludes = tuple(excludes)
+
+    def _match(self, arcname, patterns):
+        parts = arcname.split("/")
+        for pattern in patterns:
+            if "/" in pattern:
+                if fnmatch.fnmatchcase(arcname, pattern):
+                    return True
+            elif any(fnmatch.fnmatchcase(part, pattern) for part in parts):
+                return True
+        return False
+
+    def excluded(self, arcname):
+        if self._match(arcname, self.includes):
+            return False
+        return self._match(arcname, self.excludes)
+
+
+def get_rules(scenario, includes=(), excludes=()):
+    """Returns the rules of a scenario, with extra patterns."""
+    scenario_includes, scenario_excludes = SCENARIO_RULES.get(scenario, ((), ()))
+    return Rules(
+        tuple(scenario_includes) + tuple(includes),
+        DEFAULT_EXCLUDES + tuple(scenario_excludes) + tuple(excludes),
+    )
+
+
+def get_size(path):
+    """Returns the size of a file, or of everything in a directory."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+
+def _db_size(path):
+    size = 0
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            size += os.path.getsize(path + suffix)
+    return size
+
+
+def compact_database(path, vacuum=True, vacuum_ratio=VACUUM_RATIO):
+    """Checkpoints and maybe vacuums a database. Returns the bytes saved.
+
+    Vacuuming rewrites the whole file, so it's only done when it's worth
+    it, to keep unchanged databases out of diffs.
+    """
+    before = _db_size(path)
+    checkpoint = os.path.exists(path + "-wal")
+    if not checkpoint and not vacuum:
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        if checkpoint:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if vacuum:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            if pages and free / pages >= vacuum_ratio:
+                conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return before - _db_size(path)
+
+
+def compact_databases(files, vacuum=True, vacuum_ratio=VACUUM_RATIO):
+    """Compacts the databases among (path, arcname) files.
+
+    Write-ahead logs are always checkpointed, since they are left out of
+    archives. Returns the bytes saved. Databases that can't be opened are
+    left alone.
+    """
+    saved = 0
+    for path, arcname in files:
+        name = os.path.basename(arcname)
+        if not any(fnmatch.fnmatchcase(name, p) for p in DATABASE_PATTERNS):
+            continue
+        if not os.path.isfile(path):
+            continue
+        try:
+            saved += compact_database(path, vacuum, vacuum_ratio)
+        except sqlite3.Error as e:
+            logger.msg("Could not compact %r: %s" % (arcname, e))
+    return saved
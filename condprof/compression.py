@@ -0,0 +1,241 @@
+"""Compression codecs used for the profile archives.
+
+The gzip codec can compress with several threads: the tar stream is cut
+into blocks that are deflated independently and written one after the
+other as separate gzip members. Concatenated members are a valid gzip
+file, so the result is still readable by tarfile, gzip or tar.
+
+Independent members also make gzip archives seekable: when frames are
+recorded, every member's (uncompressed offset, compressed offset) is
+kept, so a part of the tar stream can be read by decompressing only the
+members around it.
+
+Incremental archives go one step further: members are also cut after
+anchor files, picked by name, and around large files and directories,
+so the same run of unchanged files is compressed to the same bytes
+every day and can be copied from the previous archive instead of being
+compressed again.
+
+The zstd codec needs the zstandard package.
+"""
+
+import contextlib
+import os
+import stat as statmod
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+CODECS = ("gz", "zstd")
+EXTENSIONS = {"gz": ".tar.gz", "zstd": ".tar.zst"}
+DEFAULT_LEVEL = 9
+BLOCK_SIZE = 1024 * 1024
+# smaller blocks for seekable archives, that's the random access granularity
+FRAME_SIZE = 256 * 1024
+# one file out of that many ends a gzip member in incremental archives
+ANCHOR = 4
+
+
+def get_codec(filename):
+    if filename.endswith(".zst"):
+        return "zstd"
+    return "gz"
+
+
+def is_anchor(arcname):
+    """Tells if a gzip member ends after that file in incremental archives."""
+    return zlib.crc32(arcname.encode("utf8")) % ANCHOR == 0
+
+
+def is_isolated(stat):
+    """Tells if a file gets gzip members of its own in incremental archives.
+
+    That's large files, and directories since their mtime changes with
+    their content.
+    """
+    return stat.st_size >= FRAME_SIZE or statmod.S_ISDIR(stat.st_mode)
+
+
+def _deflate(data, level):
+    # wbits=31 produces a full gzip member (header + deflate + trailer)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """File-like object compressing what's written to it in parallel.
+
+    Every block_size bytes are sent to a pool of threads and the
+    resulting gzip members are written to fileobj in order. At most two
+    blocks per worker are kept in memory. When frames is a list, the
+    (uncompressed offset, compressed offset) of every member is appended
+    to it.
+
+    cut() ends the current member early, and copy() adds a member that
+    is already compressed.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        level=DEFAULT_LEVEL,
+        workers=None,
+        block_size=BLOCK_SIZE,
+        frames=None,
+    ):
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.frames = frames
+        self.closed = False
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._read = self._written = 0
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def tell(self):
+        return self._read + len(self._buffer)
+
+    def _submit(self, block):
+        future = self._executor.submit(_deflate, block, self.level)
+        self._queue(future, len(block))
+
+    def _queue(self, future, size):
+        self._pending.append((self._read, future))
+        self._read += size
+        while len(self._pending) > self.workers * 2:
+            self._write_next()
+
+    def cut(self):
+        """Ends the current gzip member."""
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def copy(self, member, size):
+        """Adds a gzip member holding size bytes of uncompressed data."""
+        self.cut()
+        future = Future()
+        future.set_result(member)
+        self._queue(future, size)
+
+    def _write_next(self):
+        offset, future = self._pending.popleft()
+        member = future.result()
+        if self.frames is not None:
+            self.frames.append([offset, self._written])
+        self.fileobj.write(member)
+        self._written += len(member)
+
+    def _drain(self):
+        while self._pending:
+            self._write_next()
+
+    def flush(self):
+        self.cut()
+        self._drain()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+            self.closed = True
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("You need to run pip install zstandard")
+    return zstandard
+
+
+@contextlib.contextmanager
+def open_archive(
+    filename, mode="r", codec=None, level=DEFAULT_LEVEL, workers=1, frames=None
+):
+    """Opens a tar archive for reading ("r") or writing ("w").
+
+    When codec is None it's guessed from the filename. Reading a zstd
+    archive is done in stream mode, so members have to be read in order.
+    When writing with a frames list, the archive is made seekable and its
+    frames are added to the list.
+    """
+    if codec is None:
+        codec = get_codec(filename)
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %r" % codec)
+    if frames is not None and codec != "gz":
+        raise ValueError("Only gz archives can be seekable")
+
+    if codec == "gz" and (mode == "r" or (workers == 1 and frames is None)):
+        options = {"dereference": True}
+        if mode == "w":
+            options["compresslevel"] = level
+        with tarfile.open(filename, mode + ":gz", **options) as tar:
+            yield tar
+        return
+
+    with open(filename, mode + "b") as f:
+        if codec == "gz" and frames is not None:
+            stream = ParallelGzipWriter(f, level, workers, FRAME_SIZE, frames)
+        elif codec == "gz":
+            stream = ParallelGzipWriter(f, level=level, workers=workers)
+        elif mode == "r":
+            stream = _zstd().ZstdDecompressor().stream_reader(f)
+        else:
+            threads = workers if workers > 1 else 0
+            compressor = _zstd().ZstdCompressor(level=level, threads=threads)
+            stream = compressor.stream_writer(f, closefd=False)
+        try:
+            with tarfile.open(fileobj=stream, mode=mode + "|", dereference=True) as tar:
+                yield tar
+        finally:
+            stream.close()
+
+
+@contextlib.contextmanager
+def open_stream(fileobj, codec="gz"):
+    """Opens a tar archive read from a stream, e.g. a download."""
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %r" % codec)
+    if codec == "gz":
+        with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+            yield tar
+        return
+    stream = _zstd().ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            yield tar
+    finally:
+        stream.close()
+
+
+@contextlib.contextmanager
+def open_incremental(filename, frames, level=DEFAULT_LEVEL, workers=1):
+    """Opens a gz tar archive for writing with a ParallelGzipWriter.
+
+    The writer is tar.fileobj. The tarfile is not in stream mode, so what
+    addfile() writes reaches the writer at once and tar.offset is the
+    position in the tar stream.
+    """
+    with open(filename, "wb") as f:
+        stream = ParallelGzipWriter(f, level, workers, FRAME_SIZE, frames)
+        try:
+            with tarfile.open(fileobj=stream, mode="w", dereference=True) as tar:
+                yield tar
+        finally:
+            stream.close()
@@ -2,6 +2,7 @@ import platform
 import os
 import sys
 import argparse
+import copy
 import asyncio
 import json
 import datetime
@@ -11,18 +12,30 @@ from arsenic.browsers import Firefox
 from arsenic.services import Geckodriver, free_port, subprocess_based_service
 
 from condprof.util import fresh_profile, latest_nightly
-from condprof import logger
+from condprof import logger, tracing
+from condprof.tracing import span
 from condprof.scenario import scenario
-from condprof.client import get_profile
+from condprof.client import get_profile, get_profiles
 from condprof.archiver import Archiver
+from condprof.cache import ArtifactCache
+from condprof.compression import CODECS
+from condprof.scheduler import get_jobs, get_max_workers, run_jobs
 
 
 class CustomGeckodriver(Geckodriver):
     async def start(self):
+        # both ports are picked free so several browsers can run at once
         port = free_port()
+        marionette_port = free_port()
         await self._check_version()
         return await subprocess_based_service(
-            [self.binary, "--port", str(port), "--marionette-port", "50499"],
+            [
+                self.binary,
+                "--port",
+                str(port),
+                "--marionette-port",
+                str(marionette_port),
+            ],
             f"http://localhost:{port}",
             self.log_file,
         )
@@ -39,9 +52,45 @@ def get_age(metadata):
     return delta.days
 
 
+def prefetch_profiles(args, jobs):
+    """Gets the profile of each scenario once, and clones it for its jobs.
+
+    The profile is kept in a template dir next to the jobs ones, and
+    only jobs without a profile yet get a clone.
+    """
+    scenarii = {}
+    for job in jobs:
+        if not os.path.exists(job.profile):
+            scenarii.setdefault(job.scenarii, []).append(job.profile)
+    for name, targets in scenarii.items():
+        template = copy.copy(args)
+        template.scenarii = name
+        template.profile = os.path.join(args.profile, "%s-template" % name)
+        get_profiles(template, targets)
+
+
+def run_job(args):
+    """Builds one profile of the matrix, in its own event loop."""
+    if not os.path.exists(args.profile):
+        fresh_profile(args.profile, name=args.scenarii)
+    trace = getattr(args, "trace", False)
+    if trace:
+        tracer = tracing.enable()
+    loop = asyncio.new_event_loop()
+    try:
+        with span("job", scenario=args.scenarii):
+            return loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+        if trace:
+            label = "%s-%s" % (args.scenarii, args.customization)
+            tracer.export(os.path.join(args.log_dir, "trace-%s.json" % label))
+            logger.msg(tracer.summary())
+
+
 async def run(args):
     # XXX todo grab older profile, and set args.profile
-    with latest_nightly(args.firefox) as binary:
+    with latest_nightly(args.firefox, args.cache) as binary:
         args.firefox = os.path.abspath(binary)
         await build_profile(args)
 
@@ -66,14 +115,16 @@ async def run(args):
     name = name % archiver.metadata
     archive_name = os.path.join(args.archive, name)
     # no diffs for now
-    archiver.create_archive(archive_name)
+    with span("archive"):
+        archiver.create_archive(archive_name)
     logger.msg("Archive created at %s" % archive_name)
 
 
 async def build_profile(args):
     scenarii = scenario[args.scenarii]
     if not args.force_new:
-        get_profile(args)
+        with span("get_profile"):
+            get_profile(args)
     logger.msg("Updating profile located at %r" % args.profile)
     metadata_file = os.path.join(args.profile, ".hp.json")
 
@@ -89,12 +140,20 @@ async def build_profile(args):
         caps["moz:firefoxOptions"]["binary"] = args.firefox
 
     logger.msg("Starting the Fox...")
-    with open("gecko.log", "a+") as glog:
-        async with get_session(
-            CustomGeckodriver(log_file=glog), Firefox(**caps)
-        ) as session:
+    with open(getattr(args, "gecko_log", "gecko.log"), "a+") as glog:
+        browser = get_session(CustomGeckodriver(log_file=glog), Firefox(**caps))
+        # entered by hand so the start alone is timed
+        with span("browser_start"):
+            session = await browser.__aenter__()
+        try:
             logger.msg("Running the %s scenario" % args.scenarii)
-            metadata.update(await scenarii(session, args))
+            with span("scenario", scenario=args.scenarii):
+                metadata.update(await scenarii(session, args))
+        except BaseException:
+            if not await browser.__aexit__(*sys.exc_info()):
+                raise
+        else:
+            await browser.__aexit__(None, None, None)
 
     # writing metadata
     logger.msg("Creating metadata...")
@@ -106,9 +165,9 @@ async def build_profile(args):
     metadata["platform"] = sys.platform
     metadata["age"] = get_age(metadata)
     metadata["version"] = "69.0a1"  # add the build id XXX
-    metadata["customization"] = "vanilla"  # add themes
+    metadata["customization"] = getattr(args, "customization", "vanilla")
 
-    with open(metadata_file, "w") as f:
+    with span("metadata"), open(metadata_file, "w") as f:
         f.write(json.dumps(metadata))
 
     logger.msg("Profile at %s" % args.profile)
@@ -123,6 +182,15 @@ def main(args=sys.argv[1:]):
     parser.add_argument(
         "--max-urls", help="How many URLS to visit", type=int, default=115
     )
+    parser.add_argument(
+        "--parallel-tabs",
+        help="How many tabs load URLs at the same time",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--seed", help="Seed of the URLs order, to reproduce a run", type=int
+    )
     parser.add_argument("--firefox", help="Firefox Binary", type=str, default=None)
     parser.add_argument("--scenarii", help="Scenarii to use", type=str, default="all")
     parser.add_argument(
@@ -143,25 +211,63 @@ def main(args=sys.argv[1:]):
     parser.add_argument(
         "--force-new", help="Create from scratch", action="store_true", default=False
     )
+    parser.add_argument(
+        "--no-archive-cache",
+        help="Do not keep the downloaded archive in the archives dir",
+        dest="cache_archive",
+        action="store_false",
+        default=True,
+    )
+    parser.add_argument(
+        "--codec",
+        help="Compression codec of the archives on the server",
+        choices=CODECS,
+        default="gz",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Artifact cache shared by the creators of this host",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size", help="Artifact cache budget in MB", type=int, default=None
+    )
+    parser.add_argument(
+        "--customizations",
+        help="Comma-separated customizations to build for each scenario",
+        type=str,
+        default="vanilla",
+    )
+    parser.add_argument(
+        "--workers",
+        help="How many profiles to build at the same time",
+        type=int,
+        default=get_max_workers(),
+    )
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace of every job in the logs dir",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--log-dir", help="Where geckodriver logs are written", type=str, default="."
+    )
     args = parser.parse_args(args=args)
-    if not os.path.exists(args.profile):
-        fresh_profile(args.profile)
-
-    loop = asyncio.get_event_loop()
-
-    async def run_all(args):
-        if args.scenarii != "all":
-            return await run(args)
-        res = []
-        for name in scenario.keys():
-            args.scenarii = name
-            res.append(await run(args))
-        return res
-
-    try:
-        loop.run_until_complete(run_all(args))
-    finally:
-        loop.close()
+    max_bytes = None
+    if args.cache_size is not None:
+        max_bytes = args.cache_size * 1024 * 1024
+    args.cache = ArtifactCache(args.cache_dir, max_bytes)
+    if args.scenarii == "all":
+        scenarii = list(scenario.keys())
+    else:
+        scenarii = [args.scenarii]
+    customizations = args.customizations.split(",")
+    jobs = get_jobs(args, scenarii, customizations)
+    if len(jobs) > 1 and not args.force_new:
+        prefetch_profiles(args, jobs)
+    run_jobs(run_job, jobs, args.workers)
 
     raise Exception("Allow retriggers with this exception")
 
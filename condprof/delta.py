@@ -0,0 +1,149 @@
+"""Block-level binary deltas for large mutable files.
+
+SQLite databases are updated in place one page at a time, so a day of
+browsing usually touches a small fraction of places.sqlite & co. Files
+are cut in fixed blocks (the page size for SQLite databases) and each
+block gets a short digest. A delta holds the blocks whose digest changed
+and is applied on top of the previous version of the file.
+
+Delta layout: MAGIC, a header (target size, block size, mtime, sha256 of
+the target) and then (block index, block data) records.
+"""
+import fnmatch
+import hashlib
+import os
+import struct
+
+from condprof.hashing import file_digest
+
+
+MAGIC = b"CPDELTA1"
+_HEADER = struct.Struct(">QIQ32s")
+_INDEX = struct.Struct(">Q")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+DEFAULT_BLOCK_SIZE = 4096
+# deltas are stored under that prefix in diff tarballs. Top-level dotfiles
+# are not archived, so it can't clash with a profile file
+DELTA_PREFIX = ".delta/"
+# files that get block digests in manifests
+DELTA_PATTERNS = ("*.sqlite", "*.db", "index")
+MIN_DELTA_SIZE = 64 * 1024
+# a delta is not worth it past that ratio of changed bytes
+MAX_DELTA_RATIO = 0.5
+
+
+class DeltaError(Exception):
+    pass
+
+
+def use_blocks(name, size):
+    if size < MIN_DELTA_SIZE:
+        return False
+    basename = name.split("/")[-1]
+    return any(fnmatch.fnmatch(basename, pattern) for pattern in DELTA_PATTERNS)
+
+
+def get_block_size(header):
+    """Returns the block size to use given the first 100 bytes of a file."""
+    if header.startswith(SQLITE_MAGIC) and len(header) >= 18:
+        page_size = struct.unpack(">H", header[16:18])[0]
+        if page_size == 1:
+            return 65536
+        if page_size >= 512:
+            return page_size
+    return DEFAULT_BLOCK_SIZE
+
+
+def _block_digest(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+class BlockHasher(object):
+    """Computes the digests of consecutive blocks of a stream."""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.digests = []
+        self._pending = b""
+
+    def update(self, data):
+        if self._pending:
+            data = self._pending + data
+        full = len(data) - len(data) % self.block_size
+        for start in range(0, full, self.block_size):
+            end = start + self.block_size
+            self.digests.append(_block_digest(data[start:end]))
+        self._pending = data[full:]
+
+    def finish(self):
+        if self._pending:
+            self.digests.append(_block_digest(self._pending))
+            self._pending = b""
+        return self.digests
+
+
+def changed_blocks(old, new):
+    """Returns the indexes of the blocks of new that differ from old.
+
+    old and new are [block_size, digests] pairs, as found in manifests.
+    Returns None when they can't be compared.
+    """
+    if old is None or new is None or old[0] != new[0]:
+        return None
+    old_digests = old[1]
+    return [
+        index
+        for index, digest in enumerate(new[1])
+        if index >= len(old_digests) or old_digests[index] != digest
+    ]
+
+
+def worth_it(blocks, block_size, size):
+    return blocks is not None and len(blocks) * block_size <= size * MAX_DELTA_RATIO
+
+
+def write_delta(out, src, size, block_size, blocks, mtime, digest):
+    """Writes a delta to out.
+
+    src is a stream of the new content, read sequentially, and blocks the
+    indexes of the blocks to ship.
+    """
+    out.write(MAGIC)
+    out.write(_HEADER.pack(size, block_size, int(mtime), bytes.fromhex(digest)))
+    position = 0
+    for index in blocks:
+        start = index * block_size
+        while position < start:
+            skipped = len(src.read(min(start - position, 1024 * 1024)))
+            if skipped == 0:
+                raise DeltaError("Unexpected end of data")
+            position += skipped
+        data = src.read(min(block_size, size - start))
+        position += len(data)
+        out.write(_INDEX.pack(index))
+        out.write(data)
+
+
+def apply_delta(delta, path):
+    """Patches the file at path in place with a delta read from a stream."""
+    if delta.read(len(MAGIC)) != MAGIC:
+        raise DeltaError("Not a delta")
+    size, block_size, mtime, digest = _HEADER.unpack(delta.read(_HEADER.size))
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        raise DeltaError("%r is missing" % path)
+    with f:
+        f.truncate(size)
+        while True:
+            index = delta.read(_INDEX.size)
+            if not index:
+                break
+            start = _INDEX.unpack(index)[0] * block_size
+            data = delta.read(min(block_size, size - start))
+            f.seek(start)
+            f.write(data)
+
+    if file_digest(path) != digest.hex():
+        raise DeltaError("%r does not match its delta" % path)
+    os.utime(path, (mtime, mtime))
@@ -1,63 +1,298 @@
+"""What changed between two archives.
+
+A diff info is dumped as MAGIC followed by length-prefixed records:
+change type, flags, name length, the utf8 name and then, if flagged,
+the size and digest of the file. Names can hold any character, and the
+records can be read one at a time from a tar member or an mmap.
+
+The legacy form, "TYPE:name" lines, is still read.
+"""
+import enum
+import io
+import mmap
+import struct
+from collections import namedtuple
+
+
+MAGIC = b"\x00CPDIFF1"
+_START = len(MAGIC)
+_RECORD = struct.Struct("<BBI")
+_SIZE = struct.Struct("<Q")
+_DIGEST = struct.Struct("<B")
+_HAS_SIZE = 1
+_HAS_DIGEST = 2
+
+
+class Change(enum.IntEnum):
+    NEW = 1
+    CHANGED = 2
+    DELTA = 3
+    DELETED = 4
+
+
+DiffEntry = namedtuple("DiffEntry", ["change", "name", "size", "digest"])
+DiffEntry.__new__.__defaults__ = (None, None)
+_COUNTERS = {
+    Change.NEW: "new",
+    Change.CHANGED: "changed",
+    Change.DELTA: "patched",
+    Change.DELETED: "deleted",
+}
+
+
+class DiffInfoError(Exception):
+    pass
+
+
 def _b(data):
+    if isinstance(data, bytes):
+        return data
     return bytes(data, "utf8")
 
 
+def _encode(change, name, size=None, digest=None):
+    name = _b(name)
+    flags = 0
+    extra = b""
+    if size is not None:
+        flags |= _HAS_SIZE
+        extra += _SIZE.pack(size)
+    if digest is not None:
+        digest = _b(digest)
+        flags |= _HAS_DIGEST
+        extra += _DIGEST.pack(len(digest)) + digest
+    return _RECORD.pack(change, flags, len(name)) + name + extra
+
+
+def _change(value):
+    try:
+        return Change(value)
+    except ValueError:
+        raise DiffInfoError("Unknown change type %d" % value)
+
+
+def _truncated():
+    return DiffInfoError("Unexpected end of data")
+
+
+def _records(view, pos=0):
+    # yields the (change, flags, start, name end, end) offsets of the
+    # records of a buffer, without decoding them
+    end = len(view)
+    while pos < end:
+        start = pos
+        if pos + _RECORD.size > end:
+            raise _truncated()
+        change, flags, length = _RECORD.unpack_from(view, pos)
+        name_end = pos = pos + _RECORD.size + length
+        if flags & _HAS_SIZE:
+            pos += _SIZE.size
+        if flags & _HAS_DIGEST:
+            if pos >= end:
+                raise _truncated()
+            pos += _DIGEST.size + view[pos]
+        if pos > end:
+            raise _truncated()
+        yield _change(change), flags, start, name_end, pos
+
+
+def _decode_buffer(view, pos=0):
+    for change, flags, start, name_end, end in _records(view, pos):
+        name_start = start + _RECORD.size
+        name = str(view[name_start:name_end], "utf8")
+        pos = name_end
+        size = digest = None
+        if flags & _HAS_SIZE:
+            size = _SIZE.unpack_from(view, pos)[0]
+            pos += _SIZE.size
+        if flags & _HAS_DIGEST:
+            pos += _DIGEST.size
+            digest = str(view[pos:end], "ascii")
+        yield DiffEntry(change, name, size, digest)
+
+
+def _read_exactly(read, size):
+    data = read(size)
+    if len(data) != size:
+        raise _truncated()
+    return data
+
+
+def _decode_stream(read):
+    while True:
+        header = read(_RECORD.size)
+        if len(header) == 0:
+            return
+        if len(header) != _RECORD.size:
+            raise _truncated()
+        change, flags, length = _RECORD.unpack(header)
+        change = _change(change)
+        name = _read_exactly(read, length).decode("utf8")
+        size = digest = None
+        if flags & _HAS_SIZE:
+            size = _SIZE.unpack(_read_exactly(read, _SIZE.size))[0]
+        if flags & _HAS_DIGEST:
+            length = _DIGEST.unpack(_read_exactly(read, _DIGEST.size))[0]
+            digest = _read_exactly(read, length).decode("ascii")
+        yield DiffEntry(change, name, size, digest)
+
+
+def _decode_legacy(data):
+    for line in io.BytesIO(data):
+        line = line.strip()
+        if line == b"":
+            continue
+        change, __, name = line.partition(b":")
+        try:
+            change = Change[change.decode("ascii")]
+        except (KeyError, UnicodeDecodeError):
+            raise DiffInfoError("Unknown change %r" % line)
+        yield DiffEntry(change, name.decode("utf8"))
+
+
+def iter_changes(source):
+    """Yields the DiffEntry records of a dumped diff info.
+
+    source is bytes, an mmap or a file object. Records are decoded one at
+    a time, except for the legacy text form which is read at once.
+    """
+    if hasattr(source, "read") and not isinstance(source, mmap.mmap):
+        magic = source.read(len(MAGIC))
+        if magic == MAGIC:
+            yield from _decode_stream(source.read)
+        else:
+            yield from _decode_legacy(magic + source.read())
+        return
+    view = memoryview(source)
+    if view[:_START] == MAGIC:
+        yield from _decode_buffer(view, _START)
+    else:
+        yield from _decode_legacy(bytes(view))
+
+
+class FastComparison(object):
+    """Files are compared by size and modification time."""
+
+    def changed(self, old, new):
+        if old.type != new.type or old.size != new.size:
+            return True
+        return old.mtime != new.mtime or old.mode != new.mode
+
+
+class ExactComparison(object):
+    """Files are compared by content digest.
+
+    Touching a file without changing it is not a change, and neither is a
+    directory mtime update.
+    """
+
+    def changed(self, old, new):
+        if old.type != new.type or old.size != new.size:
+            return True
+        if old.mode != new.mode:
+            return True
+        if old.digest is None and new.digest is None:
+            # directories, links and such
+            return False
+        return old.digest != new.digest
+
+
+COMPARISONS = {"fast": FastComparison, "exact": ExactComparison}
+
+
 class DiffInfo(object):
-    def __init__(self):
-        self._info = []
+    """The changes between two archives.
+
+    Changes are kept encoded in a single buffer, iterating on them yields
+    DiffEntry tuples.
+    """
+
+    def __init__(self, comparison="exact"):
+        if isinstance(comparison, str):
+            comparison = COMPARISONS[comparison]()
+        self.comparison = comparison
+        self._data = bytearray()
+        self._count = 0
         self.changed = 0
         self.new = 0
         self.deleted = 0
+        self.patched = 0
 
     def __repr__(self):
-        msg = "=> %d new files, %d modified, %d deleted."
-        return msg % (self.new, self.changed, self.deleted)
+        msg = "=> %d new files, %d modified, %d patched, %d deleted."
+        return msg % (self.new, self.changed, self.patched, self.deleted)
 
     def __iter__(self):
-        for change in self._info:
-            yield change.split(b":")
+        return _decode_buffer(memoryview(self._data))
 
     def __len__(self):
-        return len(self._info)
+        return self._count
 
-    def load(self, data):
-        self._info[:] = []
-        for line in data.split(b"\n"):
-            line = line.strip()
-            if line == b"":
-                continue
-            self._info.append(line)
+    def load(self, source):
+        """Loads a dumped diff info from bytes, an mmap or a file object."""
+        self._data = bytearray()
+        self._count = 0
+        self.changed = self.new = self.deleted = self.patched = 0
+        if hasattr(source, "read") and not isinstance(source, mmap.mmap):
+            source = source.read()
+        view = memoryview(source)
+        if view[:_START] != MAGIC:
+            for entry in _decode_legacy(bytes(view)):
+                self.add(*entry)
+            return
+        # records are checked and counted, then kept as they are
+        for change, __, __, __, __ in _records(view, _START):
+            self._count += 1
+            counter = _COUNTERS[change]
+            setattr(self, counter, getattr(self, counter) + 1)
+        self._data = bytearray(view[_START:])
 
     def dump(self):
-        return b"\n".join(self._info)
+        return MAGIC + bytes(self._data)
 
-    def add_changed(self, name):
-        self.changed += 1
-        self._info.append(b"CHANGED:%s" % name)
+    def add(self, change, name, size=None, digest=None):
+        self._data += _encode(change, name, size, digest)
+        self._count += 1
+        self.count(change)
 
-    def add_new(self, name):
-        self.new += 1
-        self._info.append(b"NEW:%s" % name)
+    def count(self, change):
+        """Counts a change without recording it."""
+        counter = _COUNTERS[change]
+        setattr(self, counter, getattr(self, counter) + 1)
+
+    def add_changed(self, name, size=None, digest=None):
+        self.add(Change.CHANGED, name, size, digest)
+
+    def add_new(self, name, size=None, digest=None):
+        self.add(Change.NEW, name, size, digest)
+
+    def add_delta(self, name, size=None, digest=None):
+        self.add(Change.DELTA, name, size, digest)
 
     def add_deleted(self, name):
-        self.deleted += 1
-        self._info.append(b"DELETED:%s" % name)
+        self.add(Change.DELETED, name)
 
-    def update(self, current_files, previous_files):
+    def update(self, current_files, previous_files, use_delta=None):
+        """Compares two manifests (or {name: manifest entry} mappings).
+
+        Returns the entries of current_files that are new or changed.
+        Changed entries for which use_delta(old, new) is true are recorded
+        as DELTA instead of CHANGED.
+        """
         files = []
         for name, info in current_files.items():
             if name not in previous_files:
-                self.add_new(_b(name))
+                self.add_new(name, info.size, info.digest)
+                files.append(info)
+            elif self.comparison.changed(previous_files[name], info):
+                if use_delta is not None and use_delta(previous_files[name], info):
+                    self.add_delta(name, info.size, info.digest)
+                else:
+                    self.add_changed(name, info.size, info.digest)
                 files.append(info)
-            else:
-                old = previous_files[name][0].get_info()["chksum"]
-                new = info[0].get_info()["chksum"]
-                if old != new:
-                    self.add_changed(_b(name))
-                    files.append(info)
 
         for name, info in previous_files.items():
             if name not in current_files:
-                self.add_deleted(_b(name))
+                self.add_deleted(name)
 
         return files
@@ -0,0 +1,106 @@
+"""Content hashing of profile files.
+
+Digests are kept in a cache keyed on (path, size, mtime), so a file is
+only hashed again once it changed.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def stream_digest(fileobj, buffer_size=BUFFER_SIZE):
+    """Returns the sha256 of fileobj, reading buffer_size bytes at a time."""
+    digest = hashlib.sha256()
+    chunk = fileobj.read(buffer_size)
+    while chunk:
+        digest.update(chunk)
+        chunk = fileobj.read(buffer_size)
+    return digest.hexdigest()
+
+
+def file_digest(path, buffer_size=BUFFER_SIZE):
+    with open(path, "rb") as f:
+        return stream_digest(f, buffer_size)
+
+
+class HashCache(object):
+    def __init__(self, path=None):
+        self.path = path
+        self._digests = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                try:
+                    data = json.loads(f.read())
+                except ValueError:
+                    data = []
+            for name, size, mtime, digest in data:
+                self._digests[name] = size, mtime, digest
+
+    def __len__(self):
+        return len(self._digests)
+
+    def get(self, name, size, mtime):
+        cached = self._digests.get(name)
+        if cached is None or cached[:2] != (size, mtime):
+            return None
+        return cached[2]
+
+    def set(self, name, size, mtime, digest):
+        self._digests[name] = size, mtime, digest
+
+    def prune(self, names):
+        """Forgets every entry that's not in names."""
+        names = set(names)
+        for name in list(self._digests):
+            if name not in names:
+                del self._digests[name]
+
+    def save(self):
+        if self.path is None:
+            return
+        data = [[name] + list(value) for name, value in self._digests.items()]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(data))
+        os.replace(tmp, self.path)
+
+
+def hash_files(files, cache, workers=1, buffer_size=BUFFER_SIZE):
+    """Hashes files using a pool of threads.
+
+    files is an iterable of (name, path) and the digests are looked up and
+    stored in cache under name. Returns a {name: (size, mtime, digest)}
+    mapping. Files that vanish are skipped.
+    """
+    res = {}
+    todo = []
+    for name, path in files:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        digest = cache.get(name, stat.st_size, stat.st_mtime)
+        if digest is None:
+            todo.append((name, path, stat))
+        else:
+            res[name] = stat.st_size, stat.st_mtime, digest
+
+    def _hash(item):
+        name, path, stat = item
+        try:
+            return item, file_digest(path, buffer_size)
+        except FileNotFoundError:
+            return item, None
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for (name, path, stat), digest in executor.map(_hash, todo):
+            if digest is None:
+                continue
+            cache.set(name, stat.st_size, stat.st_mtime, digest)
+            res[name] = stat.st_size, stat.st_mtime, digest
+
+    return res
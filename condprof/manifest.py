@@ -0,0 +1,118 @@
+"""Manifests describe the members of an archive.
+
+A manifest is written next to each archive (archive + ".manifest") so
+archives can be compared without being decompressed. For seekable
+archives, info["frames"] lists the [uncompressed offset, compressed
+offset] of every gzip member. Incremental archives also have
+info["end"], the offset where their last member ends.
+"""
+import json
+import os
+import tarfile
+from collections import OrderedDict, namedtuple
+
+
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 1
+
+# offset is the position of the member header in the uncompressed tar stream
+# and data_offset the one of its data, past any long name or pax header.
+# blocks is the [block_size, block digests] pair used for deltas, if any
+Entry = namedtuple(
+    "Entry",
+    [
+        "name",
+        "type",
+        "size",
+        "mtime",
+        "mode",
+        "digest",
+        "offset",
+        "blocks",
+        "data_offset",
+    ],
+)
+Entry.__new__.__defaults__ = (None, None)
+
+
+def get_manifest_path(archive):
+    return archive + MANIFEST_SUFFIX
+
+
+def get_data_offset(tar, tarinfo):
+    """Returns the data offset of the member tar.addfile() just wrote."""
+    blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+    return tar.offset - blocks * tarfile.BLOCKSIZE
+
+
+def entry_from_tarinfo(
+    tarinfo, digest=None, offset=None, blocks=None, data_offset=None
+):
+    if offset is None:
+        offset = tarinfo.offset
+        data_offset = tarinfo.offset_data
+    return Entry(
+        tarinfo.name,
+        tarinfo.type.decode("ascii"),
+        tarinfo.size,
+        int(tarinfo.mtime),
+        tarinfo.mode,
+        digest,
+        offset,
+        blocks,
+        data_offset,
+    )
+
+
+class Manifest(object):
+    """Entries of an archive, plus some info about the archive itself.
+
+    info can hold the "snapshot" date and the "size" of the archive.
+    """
+
+    def __init__(self, entries=None, info=None):
+        self._entries = OrderedDict()
+        self.info = info or {}
+        for entry in entries or []:
+            self.add(entry)
+
+    def __repr__(self):
+        return "<Manifest %d entries>" % len(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __getitem__(self, name):
+        return self._entries[name]
+
+    def items(self):
+        return self._entries.items()
+
+    def add(self, entry):
+        self._entries[entry.name] = entry
+
+    def dump(self, filename):
+        data = {
+            "version": MANIFEST_VERSION,
+            "info": self.info,
+            "entries": [list(entry) for entry in self],
+        }
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(data))
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.loads(f.read())
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError("Unsupported manifest version in %r" % filename)
+        entries = (Entry(*entry) for entry in data["entries"])
+        return cls(entries, data.get("info"))
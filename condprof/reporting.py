@@ -0,0 +1,188 @@
+"""Progress of long tasks, in files and bytes.
+
+Tasks are updated from hot loops::
+
+    with task("archive", files=count) as t:
+        for ...:
+            t.add(files=1, bytes=size)
+
+An update is a couple of additions and a clock read. The running tasks
+are rendered together on one stderr line, at most once per REFRESH
+seconds, with their throughput and ETA. When stderr isn't a terminal or
+on TaskCluster, tasks are a shared object doing nothing.
+"""
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+# seconds between two renderings
+REFRESH = 0.2
+_MB = 1024 * 1024
+
+
+class _NullTask(object):
+    def add(self, files=0, bytes=0):
+        pass
+
+    def done(self):
+        pass
+
+
+_NULL_TASK = _NullTask()
+
+
+def _format_time(seconds):
+    return time.strftime("%H:%M:%S", time.gmtime(seconds))
+
+
+class Task(object):
+    """A task of a reporter. add() is not thread-safe."""
+
+    def __init__(self, reporter, label, total_files=None, total_bytes=None):
+        self.reporter = reporter
+        self.label = label
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = self.bytes = 0
+        self.start = time.monotonic()
+
+    def add(self, files=0, bytes=0):
+        self.files += files
+        self.bytes += bytes
+        now = time.monotonic()
+        if now >= self.reporter.deadline:
+            self.reporter.render(now)
+
+    def done(self):
+        self.reporter.finish(self)
+
+    def status(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        parts = [self.label]
+        if self.total_files:
+            parts.append("%d/%d files" % (self.files, self.total_files))
+        elif self.files:
+            parts.append("%d files" % self.files)
+        if self.total_bytes:
+            mb = (self.bytes / _MB, self.total_bytes / _MB)
+            parts.append("%.1f/%.1f MB" % mb)
+        elif self.bytes:
+            parts.append("%.1f MB" % (self.bytes / _MB))
+        if self.bytes:
+            parts.append("%.1f MB/s" % (self.bytes / elapsed / _MB))
+        if self.total_bytes:
+            ratio = self.bytes / self.total_bytes
+        elif self.total_files:
+            ratio = self.files / self.total_files
+        else:
+            ratio = 0
+        if 0 < ratio < 1:
+            parts.append("ETA %s" % _format_time(elapsed * (1 - ratio) / ratio))
+        return " ".join(parts)
+
+
+class Reporter(object):
+    """Renders the running tasks on a stream.
+
+    A task that is over gets its last status on a line of its own.
+    """
+
+    def __init__(self, stream, refresh=REFRESH):
+        self.stream = stream
+        self.refresh = refresh
+        self.tasks = []
+        # tasks render when the clock passes it
+        self.deadline = 0.0
+        self._width = 0
+        self._lock = threading.Lock()
+
+    def start(self, label, files=None, bytes=None):
+        task = Task(self, label, files, bytes)
+        with self._lock:
+            self.tasks.append(task)
+            self.deadline = 0.0
+        return task
+
+    def _write(self, line):
+        self.stream.write("\r" + line.ljust(self._width))
+        self._width = len(line)
+
+    def render(self, now):
+        # another thread is rendering, no need to wait for it
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if now < self.deadline:
+                return
+            self.deadline = now + self.refresh
+            self._write(" | ".join(task.status(now) for task in self.tasks))
+            self.stream.flush()
+        finally:
+            self._lock.release()
+
+    def finish(self, task):
+        now = time.monotonic()
+        with self._lock:
+            self.tasks.remove(task)
+            self._write(task.status(now))
+            self.stream.write("\n")
+            self.stream.flush()
+            self._width = 0
+            self.deadline = 0.0
+
+
+_UNSET = object()
+_reporter = _UNSET
+
+
+def _hidden(stream):
+    # TaskCluster logs are not read live
+    if "TASKCLUSTER_WORKER_TYPE" in os.environ:
+        return True
+    try:
+        return not stream.isatty()
+    except AttributeError:
+        return True
+
+
+def enable(stream=None, refresh=REFRESH):
+    """Shows the progress on stream (stderr by default), even if hidden."""
+    global _reporter
+    _reporter = Reporter(stream or sys.stderr, refresh)
+    return _reporter
+
+
+def disable():
+    global _reporter
+    _reporter = None
+
+
+def get_reporter():
+    global _reporter
+    if _reporter is _UNSET:
+        _reporter = None if _hidden(sys.stderr) else Reporter(sys.stderr)
+    return _reporter
+
+
+def start(label, files=None, bytes=None):
+    """Starts a task, with its expected files and bytes when known.
+
+    The caller calls done() on it once it's over.
+    """
+    reporter = get_reporter()
+    if reporter is None:
+        return _NULL_TASK
+    return reporter.start(label, files, bytes)
+
+
+@contextlib.contextmanager
+def task(label, files=None, bytes=None):
+    """Reports the progress of the block, when the progress is shown."""
+    current = start(label, files, bytes)
+    try:
+        yield current
+    finally:
+        current.done()
@@ -0,0 +1,112 @@
+"""Retention of the dated archives and diffs of an archives dir.
+
+Every update adds a full archive and a diff with the previous day. A
+policy decides which full archives are kept: the last dailies ones, and
+the last one of each of the last weeklies weeks. For each of them a
+squashed diff to the latest archive is built, so a client that is k days
+behind downloads one diff instead of k. Everything else goes away.
+"""
+import os
+import re
+from datetime import datetime
+
+from condprof.manifest import MANIFEST_SUFFIX
+
+
+DEFAULT_DAILIES = 10
+DEFAULT_WEEKLIES = 4
+_DATE = r"(\d{4}-\d{2}-\d{2})"
+# files that go with an archive, removed after it
+SIDECARS = (".sha256", ".asc", MANIFEST_SUFFIX)
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class RetentionPolicy(object):
+    def __init__(self, dailies=DEFAULT_DAILIES, weeklies=DEFAULT_WEEKLIES):
+        if dailies < 1:
+            raise ValueError("At least one daily archive has to be kept")
+        self.dailies = dailies
+        self.weeklies = weeklies
+
+    def __repr__(self):
+        return "<RetentionPolicy %d dailies, %d weeklies>" % (
+            self.dailies,
+            self.weeklies,
+        )
+
+    def keep(self, dates):
+        """Returns the dates to keep among dates."""
+        dates = sorted(set(dates), reverse=True)
+        dailies = self.dailies
+        keep = set(dates[:dailies])
+        weeks = set()
+        for day in dates:
+            if len(weeks) == self.weeklies:
+                break
+            week = day.isocalendar()[:2]
+            if week not in weeks:
+                weeks.add(week)
+                keep.add(day)
+        return keep
+
+
+def scan(archives_dir, name):
+    """Returns the dated files of a profile in archives_dir.
+
+    Returns a ({date: [filename]}, {(date1, date2): [filename]}) pair for
+    the full archives (and snapshots) and for the diffs, sidecars
+    included. The -latest links are not dated, so never listed.
+    """
+    full = re.compile(re.escape(name) + "-%s-hp[.]" % _DATE)
+    diff = re.compile(re.escape(name) + "-diff-%s-%s-hp[.]" % (_DATE, _DATE))
+    archives = {}
+    diffs = {}
+    for filename in os.listdir(archives_dir):
+        match = full.match(filename)
+        if match is not None:
+            day = _parse_date(match.group(1))
+            archives.setdefault(day, []).append(filename)
+            continue
+        match = diff.match(filename)
+        if match is not None:
+            days = _parse_date(match.group(1)), _parse_date(match.group(2))
+            diffs.setdefault(days, []).append(filename)
+    return archives, diffs
+
+
+def _linked(archives_dir):
+    linked = set()
+    for filename in os.listdir(archives_dir):
+        path = os.path.join(archives_dir, filename)
+        if os.path.islink(path):
+            linked.add(os.path.realpath(path))
+    return linked
+
+
+def remove_files(archives_dir, filenames):
+    """Removes files from archives_dir. Returns the bytes freed.
+
+    Sidecars are removed after their archive, so a checksum or a manifest
+    never describes a missing file that could still be downloaded.
+    Targets of symlinks (the -latest ones) are left alone.
+    """
+    linked = _linked(archives_dir)
+    freed = 0
+
+    def _order(filename):
+        return filename.endswith(SIDECARS), filename
+
+    for filename in sorted(filenames, key=_order):
+        path = os.path.join(archives_dir, filename)
+        if os.path.realpath(path) in linked:
+            continue
+        try:
+            size = os.lstat(path).st_size
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        freed += size
+    return freed
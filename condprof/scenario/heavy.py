@@ -1,57 +1,210 @@
+import functools
+import itertools
 import random
 import os
+import time
+from collections import deque
+from urllib.parse import urlparse
 from condprof import logger
 import asyncio
 
+from arsenic.errors import ArsenicError
 
-WORDS = os.path.join(os.path.dirname(__file__), "words.txt")
-with open(WORDS) as f:
-    WORDS = f.readlines()
+from condprof.scenario.navigation import NavigationPolicy, TabSwitcher
 
 
+WORDS = os.path.join(os.path.dirname(__file__), "words.txt")
 URLS = os.path.join(os.path.dirname(__file__), "urls.txt")
-with open(URLS) as f:
-    URLS = f.readlines()
 
 
-URL_LIST = []
+def _read_list(path):
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+@functools.lru_cache(maxsize=None)
+def _corpus():
+    return _read_list(URLS), _read_list(WORDS)
+
 
+def corpus_size():
+    urls, words = _corpus()
+    return len(urls) * len(words)
 
-def _build_url_list():
-    for url in URLS:
-        url = url.strip()
-        if url.startswith("#"):
+
+def iter_urls(seed):
+    """Yields the url x word corpus in a random order set by seed.
+
+    Pairs are drawn without replacement and only formatted when they
+    are consumed, so the full corpus is never built unless it's all
+    visited.
+    """
+    urls, words = _corpus()
+    total = len(urls) * len(words)
+    rand = random.Random(seed)
+    seen = set()
+    # drawing and rejecting is cheap until half the corpus is visited,
+    # the rest is shuffled
+    while len(seen) < total // 2:
+        index = rand.randrange(total)
+        if index in seen:
             continue
-        for word in WORDS:
-            word = word.strip()
-            if word.startswith("#"):
-                continue
-            URL_LIST.append(url.format(word))
-    random.shuffle(URL_LIST)
+        seen.add(index)
+        yield urls[index % len(urls)].format(words[index // len(urls)])
+    left = [index for index in range(total) if index not in seen]
+    rand.shuffle(left)
+    for index in left:
+        yield urls[index % len(urls)].format(words[index // len(urls)])
 
 
-_build_url_list()
 _TAB_OPEN = "window.open();"
+# the marker set before navigating is gone once the new document is there
+_NAVIGATE = "window.__condprof = true; window.location.href = arguments[0];"
+_LOADED = "return !window.__condprof && document.readyState == 'complete';"
+# how often tabs are checked while they load
+_POLL = 0.2
+# how many urls can be drawn to find one that can be loaded right away
+MAX_PULLS = 100
+# how many urls can wait for their host to be available. Only reached when
+# most hosts are busy or skipped for a long time
+MAX_WAITING = 10000
+# navigation budget, see NavigationPolicy
+POLICY = {"timeout": 5, "max_timeout": 15, "retries": 3, "per_host": 4}
+
+
+async def load_sequentially(session, tabs, urls, total, policy):
+    visited = 0
+    for current, url in enumerate(urls):
+        logger.visit_url(index=current + 1, total=total, url=url)
+        for attempt in range(policy.retries):
+            if policy.skipped(url):
+                logger.msg("Skipping unhealthy host for %s" % url)
+                break
+            await asyncio.sleep(policy.delay(attempt))
+            policy.started(url)
+            since = time.monotonic()
+            try:
+                await asyncio.wait_for(session.get(url), policy.timeout(url))
+            except asyncio.TimeoutError:
+                policy.failed(url)
+            else:
+                policy.succeeded(url, time.monotonic() - since)
+                visited += 1
+                break
+        await tabs.switch()
+    return visited
+
+
+async def _is_loaded(session, handle):
+    await session.switch_to_window(handle)
+    try:
+        return await session.execute_script(_LOADED)
+    except ArsenicError:
+        # the document can go away while we look at it
+        return False
+
 
+class _Waiting(object):
+    """Urls that can't be loaded yet, in one queue per host.
 
-class TabSwitcher(object):
-    def __init__(self, session):
-        self.handles = None
-        self.current = 0
-        self.session = session
+    A busy or skipped host only holds up its own urls, and they are kept
+    until it's available again.
+    """
 
-    async def switch(self):
-        session = self.session
-        if self.handles is None:
-            self.handles = await session.get_window_handles()
-            self.current = 0
+    def __init__(self, policy):
+        self.policy = policy
+        self.hosts = {}
+        self.size = 0
 
-        handle = self.handles[self.current]
-        if self.current == len(self.handles) - 1:
-            self.current = 0
-        else:
-            self.current += 1
-        await session.switch_to_window(handle)
+    def __len__(self):
+        return self.size
+
+    def add(self, url, attempt, ready):
+        queue = self.hosts.setdefault(urlparse(url).netloc, deque())
+        queue.append((url, attempt, ready))
+        self.size += 1
+
+    def pop(self, now):
+        """Returns the first ready (url, attempt) of an available host."""
+        for queue in self.hosts.values():
+            if not queue or not self.policy.available(queue[0][0]):
+                continue
+            for item in queue:
+                if item[2] <= now:
+                    queue.remove(item)
+                    self.size -= 1
+                    return item[:2]
+        return None
+
+
+def _pick(policy, waiting, urls):
+    """Returns the next (url, attempt) that can be loaded, if any.
+
+    Urls that have to wait (retry delay, busy or unhealthy host) are kept
+    in waiting. Up to MAX_PULLS urls are drawn to find one whose host is
+    available, so healthy hosts keep feeding idle tabs.
+    """
+    now = time.monotonic()
+    picked = waiting.pop(now)
+    if picked is not None:
+        return picked
+    for i in range(MAX_PULLS):
+        if len(waiting) >= MAX_WAITING:
+            break
+        url = next(urls, None)
+        if url is None:
+            break
+        if policy.available(url):
+            return url, 0
+        waiting.add(url, 0, now)
+    return None
+
+
+async def load_concurrently(session, tabs, urls, total, concurrency, policy):
+    """Loads urls in several tabs at the same time.
+
+    Navigations are started in every idle tab, then loading tabs are
+    polled until their page is complete or times out. The policy sets the
+    timeouts, retries and how many tabs can load from the same host.
+    """
+    idle = list((await tabs.get_handles())[:concurrency])
+    loading = {}
+    urls = iter(urls)
+    waiting = _Waiting(policy)
+    visited = started = 0
+    while True:
+        while idle:
+            picked = _pick(policy, waiting, urls)
+            if picked is None:
+                break
+            url, attempt = picked
+            if attempt == 0:
+                started += 1
+                logger.visit_url(index=started, total=total, url=url)
+            handle = idle.pop()
+            await session.switch_to_window(handle)
+            await session.execute_script(_NAVIGATE, url)
+            policy.started(url)
+            loading[handle] = url, attempt, time.monotonic(), policy.timeout(url)
+
+        if not loading and not waiting:
+            return visited
+
+        await asyncio.sleep(_POLL)
+        for handle, (url, attempt, since, timeout) in list(loading.items()):
+            if await _is_loaded(session, handle):
+                policy.succeeded(url, time.monotonic() - since)
+                visited += 1
+            elif time.monotonic() - since < timeout:
+                continue
+            else:
+                policy.failed(url)
+                if attempt + 1 < policy.retries:
+                    ready = time.monotonic() + policy.delay(attempt + 1)
+                    waiting.add(url, attempt + 1, ready)
+            del loading[handle]
+            idle.append(handle)
 
 
 async def heavy(session, args):
@@ -64,23 +217,30 @@ async def heavy(session, args):
         await session.execute_script(_TAB_OPEN)
 
     tabs = TabSwitcher(session)
-    visited = 0
-
-    for current, url in enumerate(URL_LIST):
-        logger.visit_url(index=current + 1, total=max, url=url)
-        retries = 0
-        while retries < 3:
-            try:
-                await asyncio.wait_for(session.get(url), 5)
-                visited += 1
-                break
-            except asyncio.TimeoutError:
-                retries += 1
-
-        if max != -1 and current + 1 == max:
-            break
-
-        await tabs.switch()
+    # the seed is kept in the metadata, so the run can be reproduced
+    seed = getattr(args, "seed", None)
+    if seed is None:
+        seed = random.randrange(2**32)
+    metadata["seed"] = seed
+    urls = iter_urls(seed)
+    total = corpus_size()
+    if max != -1:
+        total = min(max, total)
+        urls = itertools.islice(urls, max)
+    concurrency = getattr(args, "parallel_tabs", 1)
+    policy = NavigationPolicy(**POLICY)
+
+    start = time.monotonic()
+    if concurrency > 1:
+        visited = await load_concurrently(
+            session, tabs, urls, total, concurrency, policy
+        )
+    else:
+        visited = await load_sequentially(session, tabs, urls, total, policy)
+    elapsed = time.monotonic() - start
 
     metadata["visited_url"] = visited
+    metadata["hosts"] = policy.stats()
+    if elapsed > 0:
+        metadata["urls_per_minute"] = round(visited * 60 / elapsed, 1)
     return metadata
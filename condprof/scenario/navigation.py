@@ -0,0 +1,137 @@
+"""Helpers for the scenarios that browse the web."""
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+
+class TabSwitcher(object):
+    def __init__(self, session):
+        self.handles = None
+        self.current = 0
+        self.session = session
+
+    async def get_handles(self):
+        if self.handles is None:
+            self.handles = await self.session.get_window_handles()
+            self.current = 0
+        return self.handles
+
+    async def switch(self):
+        handles = await self.get_handles()
+        handle = handles[self.current]
+        if self.current == len(handles) - 1:
+            self.current = 0
+        else:
+            self.current += 1
+        await self.session.switch_to_window(handle)
+
+
+class _Host(object):
+    def __init__(self, samples):
+        self.latencies = deque(maxlen=samples)
+        self.in_flight = 0
+        self.failures = 0
+        self.skip_until = 0
+
+
+class NavigationPolicy(object):
+    """Decides how long to wait for a page, and when to leave a host alone.
+
+    - the timeout of a host follows its observed latency: a percentile of
+      the last page loads times factor, between min_timeout and
+      max_timeout. Until enough loads are seen, timeout is used.
+    - after max_failures failures in a row, a host is skipped for backoff
+      seconds, doubled on every new failure up to max_backoff.
+    - at most per_host navigations run against the same host.
+    - a url gets at most retries attempts. The first retry waits for
+      retry_delay, and that delay doubles on every new attempt.
+
+    Scenarios pass their own budget as keyword arguments.
+    """
+
+    def __init__(
+        self,
+        timeout=5,
+        min_timeout=2,
+        max_timeout=15,
+        percentile=0.9,
+        factor=2,
+        samples=50,
+        per_host=2,
+        retries=3,
+        retry_delay=1,
+        max_failures=3,
+        backoff=30,
+        max_backoff=300,
+    ):
+        self.default_timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.factor = factor
+        self.samples = samples
+        self.per_host = per_host
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._hosts = {}
+
+    def _host(self, url):
+        name = urlparse(url).netloc
+        if name not in self._hosts:
+            self._hosts[name] = _Host(self.samples)
+        return self._hosts[name]
+
+    def timeout(self, url):
+        latencies = sorted(self._host(url).latencies)
+        # a handful of loads is enough to get an idea
+        if len(latencies) < 5:
+            return self.default_timeout
+        observed = latencies[int(self.percentile * (len(latencies) - 1))]
+        return min(self.max_timeout, max(self.min_timeout, observed * self.factor))
+
+    def skipped(self, url):
+        return self._host(url).skip_until > time.monotonic()
+
+    def available(self, url):
+        host = self._host(url)
+        return not self.skipped(url) and host.in_flight < self.per_host
+
+    def delay(self, attempt):
+        """Returns how long to wait before the given attempt."""
+        if attempt == 0:
+            return 0
+        return self.retry_delay * 2 ** (attempt - 1)
+
+    def started(self, url):
+        self._host(url).in_flight += 1
+
+    def succeeded(self, url, latency):
+        host = self._host(url)
+        host.in_flight -= 1
+        host.latencies.append(latency)
+        host.failures = 0
+
+    def failed(self, url):
+        host = self._host(url)
+        host.in_flight -= 1
+        host.failures += 1
+        if host.failures >= self.max_failures:
+            backoff = self.backoff * 2 ** (host.failures - self.max_failures)
+            host.skip_until = time.monotonic() + min(backoff, self.max_backoff)
+
+    def stats(self):
+        """Returns the state of every host."""
+        return dict(
+            (
+                name,
+                {
+                    "loads": len(host.latencies),
+                    "failures": host.failures,
+                    "skipped": host.skip_until > time.monotonic(),
+                },
+            )
+            for name, host in self._hosts.items()
+        )
@@ -0,0 +1,84 @@
+"""Builds the (scenario x customization) matrix in parallel.
+
+Every job runs in its own process with its own profile directory and
+geckodriver log, so several browsers can run side by side.
+"""
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from condprof import logger
+
+
+# what a headless browser and its content processes roughly use
+MEMORY_PER_BROWSER = 2 * 1024 * 1024 * 1024
+# a browser keeps about two cores busy
+CPUS_PER_BROWSER = 2
+
+
+def get_max_workers(memory_per_browser=MEMORY_PER_BROWSER):
+    """Returns how many browsers the host can run at the same time."""
+    workers = max(1, (os.cpu_count() or 1) // CPUS_PER_BROWSER)
+    try:
+        memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return workers
+    return max(1, min(workers, memory // memory_per_browser))
+
+
+def get_jobs(args, scenarii, customizations):
+    """Returns a copy of args for each (scenario, customization).
+
+    When there's more than one job, each one gets a subdirectory of
+    args.profile.
+    """
+    jobs = []
+    matrix = len(scenarii) * len(customizations) > 1
+    for name in scenarii:
+        for customization in customizations:
+            job = copy.copy(args)
+            job.scenarii = name
+            job.customization = customization
+            label = "%s-%s" % (name, customization)
+            if matrix:
+                job.profile = os.path.join(args.profile, label)
+            job.gecko_log = os.path.join(args.log_dir, "gecko-%s.log" % label)
+            jobs.append(job)
+    return jobs
+
+
+def _label(job):
+    return "%s-%s" % (job.scenarii, job.customization)
+
+
+def run_jobs(func, jobs, max_workers=None):
+    """Calls func(job) for every job, in up to max_workers processes.
+
+    func has to be a module-level function. Returns the results in the
+    jobs order, and raises the first error once all jobs are over.
+    """
+    if max_workers is None:
+        max_workers = get_max_workers()
+    max_workers = min(max_workers, len(jobs))
+    if max_workers <= 1:
+        return [func(job) for job in jobs]
+
+    logger.msg("Running %d jobs, %d at a time" % (len(jobs), max_workers))
+    results = [None] * len(jobs)
+    errors = []
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = dict(
+            (executor.submit(func, job), index) for index, job in enumerate(jobs)
+        )
+        for future in as_completed(futures):
+            job = jobs[futures[future]]
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logger.msg("%s failed: %r" % (_label(job), e))
+                errors.append(e)
+            else:
+                logger.msg("%s done" % _label(job))
+    if errors:
+        raise errors[0]
+    return results
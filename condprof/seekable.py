@@ -0,0 +1,109 @@
+"""Random access to the members of seekable archives.
+
+A seekable archive is a gzip tarball made of independent gzip members
+(frames), listed in its manifest with their uncompressed and compressed
+offsets. With the offset of a member in the tar stream, the frames that
+hold it can be read and decompressed without touching the rest of the
+archive, from a local file or with HTTP Range requests.
+
+The archive is still a regular .tar.gz for every other tool.
+"""
+import bisect
+import io
+import tarfile
+import zlib
+
+from condprof.util import get_session, ArchiveError, ArchiveNotFound
+
+
+def _gunzip(data):
+    res = []
+    while data:
+        decompressor = zlib.decompressobj(31)
+        res.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b"".join(res)
+
+
+def _read_range(archive, start, end, size):
+    if not archive.startswith(("http://", "https://")):
+        with open(archive, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+    headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+    resp = get_session().get(archive, headers=headers)
+    if resp.status_code == 200:
+        # no range support, the whole archive was sent
+        data = resp.content
+        if len(data) != size:
+            raise ArchiveError("%r does not match its manifest" % archive)
+        return data[start:end]
+    if resp.status_code != 206:
+        raise ArchiveNotFound(archive)
+    # the archive could have been replaced since the manifest was read
+    total = resp.headers.get("Content-Range", "").split("/")[-1]
+    if total != str(size):
+        raise ArchiveError("%r does not match its manifest" % archive)
+    return resp.content
+
+
+def _span(entry):
+    return entry.offset, entry.data_offset + entry.size
+
+
+def get_ranges(manifest, entries):
+    """Returns the [uncompressed start, compressed start, compressed end]
+    ranges of frames holding entries. Adjacent ranges are merged.
+    """
+    frames = manifest.info["frames"]
+    starts = [frame[0] for frame in frames]
+    ranges = []
+    for start, end in sorted(_span(entry) for entry in entries):
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_left(starts, end)
+        compressed_start = frames[first][1]
+        if last < len(frames):
+            compressed_end = frames[last][1]
+        else:
+            compressed_end = manifest.info["size"]
+        if ranges and compressed_start <= ranges[-1][2]:
+            ranges[-1][2] = max(ranges[-1][2], compressed_end)
+        else:
+            ranges.append([frames[first][0], compressed_start, compressed_end])
+    return ranges
+
+
+def is_seekable(manifest):
+    if manifest is None or "frames" not in manifest.info:
+        return False
+    # older manifests don't tell where the data of members starts
+    return all(entry.data_offset is not None for entry in manifest)
+
+
+def extract_members(archive, manifest, names, target):
+    """Extracts the named members of a seekable archive in target.
+
+    archive is a local path or an url. Returns the number of compressed
+    bytes read.
+    """
+    if not is_seekable(manifest):
+        raise ValueError("%r is not seekable" % archive)
+    entries = sorted((manifest[name] for name in names), key=lambda e: e.offset)
+    read = 0
+    for start, compressed_start, compressed_end in get_ranges(manifest, entries):
+        data = _read_range(
+            archive, compressed_start, compressed_end, manifest.info["size"]
+        )
+        read += len(data)
+        data = _gunzip(data)
+        for entry in entries:
+            if not start <= entry.offset < start + len(data):
+                continue
+            member = io.BytesIO(data)
+            member.seek(entry.offset - start)
+            with tarfile.open(fileobj=member, mode="r:") as tar:
+                tarinfo = tar.next()
+                if tarinfo is None or tarinfo.name != entry.name:
+                    raise ArchiveError("Bad offset for %r" % entry.name)
+                tar.extract(tarinfo, target)
+    return read
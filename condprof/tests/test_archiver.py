@@ -6,9 +6,11 @@ from datetime import date, timedelta
 import tempfile
 import tarfile
 from collections import namedtuple
+from unittest import mock
 
 from condprof.util import fresh_profile
-from condprof.archiver import Archiver
+from condprof.archiver import Archiver, _DiffWriter
+from condprof.diffinfo import iter_changes
 from condprof.creator import build_profile
 
 
@@ -29,6 +31,58 @@ class TestArchiver(unittest.TestCase):
         args.archives_dir = self.archives_dir
         self.archiver = Archiver(args.profile_dir, args.archives_dir)
 
+    def _read_archive(self, archive):
+        with tarfile.open(archive, "r:gz") as tar:
+            return dict(
+                (tarinfo.name, tar.extractfile(tarinfo).read())
+                for tarinfo in tar
+                if tarinfo.isfile()
+            )
+
+    def test_incremental_archiving(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, incremental=True)
+        sub = os.path.join(self.profile_dir, "sub")
+        os.mkdir(sub)
+        for i in range(50):
+            with open(os.path.join(sub, "file%d" % i), "wb") as f:
+                f.write(os.urandom(4096 * i))
+        yesterday = date.today() - timedelta(days=1)
+        archiver.update(yesterday)
+        with open(os.path.join(sub, "file25"), "wb") as f:
+            f.write(b"changed")
+        archiver.update(date.today())
+
+        old, __ = archiver._get_archive_path(yesterday)
+        new, __ = archiver._get_archive_path(date.today())
+        content = self._read_archive(new)
+        self.assertEqual(content["sub/file25"], b"changed")
+        with open(os.path.join(sub, "file49"), "rb") as f:
+            self.assertEqual(content["sub/file49"], f.read())
+
+        # most of the compressed bytes come from the previous archive
+        manifest = archiver._get_manifest(new)
+        frames = manifest.info["frames"]
+        with open(old, "rb") as f:
+            old_data = f.read()
+        with open(new, "rb") as f:
+            new_data = f.read()
+        reused = 0
+        for (__, start), (__, end) in zip(frames, frames[1:]):
+            member = new_data[start:end]
+            if member in old_data:
+                reused += len(member)
+        self.assertTrue(reused > len(new_data) * 0.8)
+        diff, content = self._read_diff(self._diff_name())
+        self.assertEqual(diff, ["CHANGED:sub/file25"])
+
+        # offsets are right
+        with open(new, "rb") as f, tarfile.open(fileobj=f, mode="r:gz") as tar:
+            for entry in manifest:
+                tar.offset = entry.offset
+                tarinfo = tar.next()
+                self.assertEqual(tarinfo.name, entry.name)
+                self.assertEqual(tarinfo.offset_data, entry.data_offset)
+
     def _diff_name(self, now=None, then=None):
         if now is None:
             now = date.today()
@@ -50,20 +104,33 @@ class TestArchiver(unittest.TestCase):
         res.sort()
         today = date.today()
         archive = today.strftime("heavy-%Y-%m-%d-hp.tar.gz")
-        wanted = [archive, "heavy-latest.tar.gz"]
+        wanted = [
+            archive,
+            archive + ".manifest",
+            "heavy-latest.tar.gz",
+            "heavy-latest.tar.gz.manifest",
+        ]
         wanted.sort()
         self.assertEqual(res, wanted)
 
+    def test_parallel_archiving(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, workers=4)
+        archive = archiver.create_archive(date.today())
+        with tarfile.open(archive, "r:gz") as tar:
+            names = tar.getnames()
+        self.assertTrue("prefs.js" in names)
+
     def test_diff_archiving(self):
         # we update the archives every day for 15 days
         # we keep the last ten days
-        wanted = ["heavy-latest.tar.gz"]
+        wanted = ["heavy-latest.tar.gz", "heavy-latest.tar.gz.manifest"]
 
         _15_days_ago = date.today() - timedelta(days=15)
 
         for i in range(15):
             when = _15_days_ago + timedelta(days=i)
             wanted.append(when.strftime("heavy-%Y-%m-%d-hp.tar.gz"))
+            wanted.append(when.strftime("heavy-%Y-%m-%d-hp.tar.gz.manifest"))
 
             if i != 0:
                 wanted.append(self._diff_name(when))
@@ -75,6 +142,89 @@ class TestArchiver(unittest.TestCase):
         res.sort()
         self.assertEqual(res, wanted)
 
+    def _read_diff(self, diffname):
+        diffname = os.path.join(self.archives_dir, diffname)
+        with tarfile.open(diffname, "r:gz") as tar:
+            content = {}
+            for tarinfo in tar:
+                if tarinfo.isfile():
+                    content[tarinfo.name] = tar.extractfile(tarinfo).read()
+        diff = iter_changes(content.pop("diffinfo"))
+        diff = ["%s:%s" % (entry.change.name, entry.name) for entry in diff]
+        return sorted(diff), content
+
+    def test_diff_content(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        self.archiver.update(yesterday)
+
+        # same size, new content
+        prefs = os.path.join(self.profile_dir, "prefs.js")
+        with open(prefs, "rb") as f:
+            data = f.read()
+        with open(prefs, "wb") as f:
+            f.write(data[::-1])
+        with open(os.path.join(self.profile_dir, "new.txt"), "wb") as f:
+            f.write(b"new")
+        os.remove(os.path.join(self.profile_dir, "user.js"))
+
+        self.archiver.update(today)
+        diff, content = self._read_diff(self._diff_name(today, yesterday))
+        wanted = ["CHANGED:prefs.js", "DELETED:user.js", "NEW:new.txt"]
+        self.assertEqual(diff, wanted)
+        self.assertEqual(content["prefs.js"], data[::-1])
+        self.assertEqual(content["new.txt"], b"new")
+
+    def test_single_pass_diff(self):
+        self.archiver = Archiver(self.profile_dir, self.archives_dir, delta=True)
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        self.archiver.update(yesterday)
+        with open(os.path.join(self.profile_dir, "prefs.js"), "a") as f:
+            f.write("// changed")
+        with open(os.path.join(self.profile_dir, "new.txt"), "wb") as f:
+            f.write(b"new")
+        os.remove(os.path.join(self.profile_dir, "user.js"))
+        self.archiver.update(today)
+        single_pass = self._read_diff(self._diff_name(today, yesterday))
+
+        # same as a diff built from both archives
+        current, __ = self.archiver._get_archive_path(today)
+        previous, __ = self.archiver._get_archive_path(yesterday)
+        self.archiver.create_diff(today, current, previous)
+        self.assertEqual(
+            single_pass, self._read_diff(self._diff_name(today, yesterday))
+        )
+        self.assertEqual(
+            single_pass[0], ["CHANGED:prefs.js", "DELETED:user.js", "NEW:new.txt"]
+        )
+
+    def test_failed_diff(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        self.archiver.update(yesterday)
+        with mock.patch.object(_DiffWriter, "finish", side_effect=OSError()):
+            self.assertRaises(OSError, self.archiver.update, today)
+        # no truncated diff that a client could fetch
+        diff = self.archiver._get_diff_path(yesterday, today)
+        self.assertFalse(os.path.exists(diff))
+        self.assertFalse(os.path.exists(diff + ".part"))
+
+    def test_diff_from_manifest(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        self.archiver.update(yesterday)
+        # the previous archive is not needed once we have its manifest
+        previous, __ = self.archiver._get_archive_path(yesterday)
+        os.remove(previous)
+
+        with open(os.path.join(self.profile_dir, "new.txt"), "wb") as f:
+            f.write(b"new")
+
+        self.archiver.update(today)
+        diff, content = self._read_diff(self._diff_name(today, yesterday))
+        self.assertEqual(diff, ["NEW:new.txt"])
+
     def test_archiving_after_changes(self):
         # this creates a heavy archive
         today = date.today()
@@ -99,9 +249,7 @@ class TestArchiver(unittest.TestCase):
             for tarinfo in tar:
                 if tarinfo.name != "diffinfo":
                     continue
-                diff = tar.extractfile(tarinfo)
-                diff = diff.read()
-                diff = [line for line in diff.split(b"\n") if line.strip() != b""]
+                diff = list(iter_changes(tar.extractfile(tarinfo)))
                 break
 
         # we have over 100 new files
@@ -117,10 +265,7 @@ class TestArchiver(unittest.TestCase):
             for tarinfo in tar:
                 if tarinfo.name != "diffinfo":
                     continue
-                diff = tar.extractfile(tarinfo)
-                diff = diff.read()
-                diff = diff.split(b"\n")
-                diff = [line for line in diff if line.strip() != b""]
+                diff = list(iter_changes(tar.extractfile(tarinfo)))
                 break
 
         # we have no difference
@@ -0,0 +1,32 @@
+import shutil
+import tempfile
+import unittest
+
+from condprof.benchmark import compare, run_suite
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_suite(self):
+        results = run_suite(self.work_dir, repeat=1, files=50, databases=1, db_rows=500)
+        wanted = [
+            "create_archive",
+            "read_tar",
+            "diffinfo_update",
+            "diffinfo_dump",
+            "diffinfo_load",
+            "create_diff",
+            "extract_profile",
+            "apply_diff",
+        ]
+        self.assertEqual(list(results["results"]), wanted)
+        self.assertTrue(results["results"]["create_archive"]["peak_memory"] > 0)
+        self.assertTrue(0 < results["diff_size"] < results["archive_size"])
+        table = compare(results, results).splitlines()
+        self.assertEqual(len(table), len(wanted) + 1)
+        self.assertTrue(table[1].endswith("1.00x"))
@@ -0,0 +1,90 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from condprof.cache import ArtifactCache
+
+
+def _fill(cache, key, size):
+    with cache.open(key) as entry:
+        if not entry.complete:
+            with open(os.path.join(entry.path, "data"), "wb") as f:
+                f.write(b"x" * size)
+            entry.commit()
+        return entry.path
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lru_eviction(self):
+        cache = ArtifactCache(self.root, max_bytes=2500)
+        one = _fill(cache, "one", 1000)
+        two = _fill(cache, "two", 1000)
+        # "one" becomes the most recently used entry
+        _fill(cache, "one", 1000)
+        three = _fill(cache, "three", 1000)
+        self.assertTrue(os.path.exists(one))
+        self.assertFalse(os.path.exists(two))
+        self.assertTrue(os.path.exists(three))
+        self.assertEqual(cache.size(), 2000)
+
+    def test_entries_in_use_are_kept(self):
+        cache = ArtifactCache(self.root, max_bytes=1500)
+        with cache.open("one") as entry:
+            with open(os.path.join(entry.path, "data"), "wb") as f:
+                f.write(b"x" * 1000)
+            entry.commit()
+            _fill(cache, "two", 1000)
+            self.assertTrue(entry.complete)
+        # once released, it can go
+        _fill(cache, "three", 1000)
+        self.assertFalse(entry.complete)
+
+    def test_uncommitted_entry(self):
+        cache = ArtifactCache(self.root)
+        with self.assertRaises(ValueError):
+            with cache.open("key") as entry:
+                with open(os.path.join(entry.path, "data"), "wb") as f:
+                    f.write(b"x" * 1000)
+                raise ValueError()
+        self.assertFalse(os.path.exists(entry.path))
+        self.assertEqual(cache.size(), 0)
+        # a complete entry survives a failed refresh
+        path = _fill(cache, "key", 1000)
+        with self.assertRaises(ValueError):
+            with cache.open("key", exclusive=True):
+                raise ValueError()
+        self.assertTrue(os.path.exists(os.path.join(path, "data")))
+
+    def test_single_writer(self):
+        cache = ArtifactCache(self.root)
+        filled = []
+
+        def fill():
+            with cache.open("key") as entry:
+                if not entry.complete:
+                    filled.append(entry.path)
+                    entry.commit()
+
+        with cache.open("key") as entry:
+            threads = [threading.Thread(target=fill) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            # the other openers wait for the entry to be filled
+            lock = os.path.join(self.root, entry.name + ".lock")
+            with open(lock) as f:
+                self.assertRaises(
+                    BlockingIOError, fcntl.flock, f, fcntl.LOCK_SH | fcntl.LOCK_NB
+                )
+            entry.commit()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(filled, [])
@@ -0,0 +1,96 @@
+import io
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+from datetime import date, timedelta
+
+from condprof.util import fresh_profile
+from condprof.archiver import Archiver
+from condprof.chunkstore import ChunkStore, iter_chunks
+
+
+def _content(archive):
+    with tarfile.open(archive, "r:gz") as tar:
+        return dict(
+            (info.name, tar.extractfile(info).read()) for info in tar if info.isfile()
+        )
+
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+
+    def test_content_defined_chunks(self):
+        rand = random.Random(1)
+        data = bytes(rand.getrandbits(8) for i in range(1024 * 1024))
+        chunks = list(iter_chunks(io.BytesIO(data)))
+        self.assertEqual(b"".join(chunks), data)
+        # an insertion only changes the chunks around it
+        shifted = data[:1000] + b"inserted" + data[1000:]
+        shifted = list(iter_chunks(io.BytesIO(shifted)))
+        self.assertEqual(len(set(chunks) - set(shifted)), 1)
+
+    def test_store(self):
+        store = ChunkStore(os.path.join(self.archives_dir, "chunks"))
+        chunks, __ = store.store_file(io.BytesIO(b"data" * 100000))
+        self.assertEqual(store.open(chunks).read(), b"data" * 100000)
+        self.assertEqual(store.gc(chunks), 0)
+        self.assertTrue(store.gc([]) > 0)
+        self.assertEqual(list(store), [])
+
+    def test_gc_waits_for_writers(self):
+        store = ChunkStore(os.path.join(self.archives_dir, "chunks"))
+        snapshots = []
+
+        def gc():
+            with store.lock(exclusive=True):
+                referenced = [chunk for chunks in snapshots for chunk in chunks]
+                store.gc(referenced)
+
+        with store.lock():
+            chunks, __ = store.store_file(io.BytesIO(b"data" * 100000))
+            thread = threading.Thread(target=gc)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            snapshots.append(chunks)
+        thread.join()
+        self.assertEqual(store.open(chunks).read(), b"data" * 100000)
+
+    def test_chunk_storage(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, storage="chunks")
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        archiver.update(yesterday)
+        old, __ = archiver._get_archive_path(yesterday)
+        old_content = _content(old)
+
+        with open(os.path.join(self.profile_dir, "new.txt"), "w") as f:
+            f.write("new")
+        archiver.update(today)
+
+        # only the latest tarball is kept, older ones are rebuilt on demand
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(archiver._get_diff_path(yesterday, today)))
+        self.assertEqual(_content(archiver.materialize(yesterday)), old_content)
+        new, __ = archiver._get_archive_path(today)
+        self.assertEqual(_content(new)["new.txt"], b"new")
+
+    def test_same_day_update(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, storage="chunks")
+        today = date.today()
+        archiver.update(today)
+        with open(os.path.join(self.profile_dir, "new.txt"), "w") as f:
+            f.write("new")
+        archiver.update(today)
+        archive, __ = archiver._get_archive_path(today)
+        self.assertEqual(_content(archive)["new.txt"], b"new")
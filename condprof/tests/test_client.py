@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import unittest
+import shutil
+import tarfile
+import tempfile
+from argparse import Namespace
+from datetime import date, timedelta
+
+from condprof.util import fresh_profile
+from condprof.archiver import Archiver
+from condprof.client import apply_diff, get_profile
+from condprof.delta import DeltaError
+from condprof.tests.support import Server
+
+
+def _read_dir(path):
+    res = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name.startswith("."):
+                continue
+            full = os.path.join(root, name)
+            with open(full, "rb") as f:
+                res[os.path.relpath(full, path)] = f.read()
+    return res
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        self.archiver = Archiver(self.profile_dir, self.archives_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+        shutil.rmtree(self.target)
+
+    def test_apply_diff(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        archive = self.archiver.create_archive(yesterday)
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(self.target)
+
+        with open(os.path.join(self.profile_dir, "prefs.js"), "a") as f:
+            f.write("// changed")
+        os.mkdir(os.path.join(self.profile_dir, "sub"))
+        with open(os.path.join(self.profile_dir, "sub", "new.txt"), "w") as f:
+            f.write("new")
+        os.remove(os.path.join(self.profile_dir, "user.js"))
+
+        self.archiver.update(today)
+        diff = self.archiver._get_diff_path(yesterday, today)
+        apply_diff(diff, self.target)
+        self.assertEqual(_read_dir(self.target), _read_dir(self.profile_dir))
+
+    def test_apply_delta(self):
+        db = os.path.join(self.profile_dir, "places.sqlite")
+        conn = sqlite3.connect(db)
+        conn.execute("create table visits (url text)")
+        for i in range(5000):
+            conn.execute("insert into visits values (?)", ("http://%d" % i,))
+        conn.commit()
+
+        archiver = Archiver(self.profile_dir, self.archives_dir, delta=True)
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        archive = archiver.create_archive(yesterday)
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(self.target)
+
+        conn.execute("update visits set url='changed' where rowid=10")
+        conn.commit()
+        conn.close()
+
+        archiver.update(today)
+        diff = archiver._get_diff_path(yesterday, today)
+        diff_info = apply_diff(diff, self.target)
+        changes = diff_info.patched, diff_info.changed + diff_info.new
+        # only the database is patched
+        self.assertEqual(changes, (1, 0))
+        self.assertEqual(_read_dir(self.target), _read_dir(self.profile_dir))
+        # the delta is much smaller than the database
+        with tarfile.open(diff, "r:gz") as tar:
+            delta = tar.getmember(".delta/places.sqlite")
+        self.assertTrue(delta.size < os.path.getsize(db) / 4)
+
+    def test_apply_delta_missing_base(self):
+        db = os.path.join(self.profile_dir, "places.sqlite")
+        with open(db, "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        archiver = Archiver(self.profile_dir, self.archives_dir, delta=True)
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        archive = archiver.create_archive(yesterday)
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(self.target)
+
+        with open(db, "r+b") as f:
+            f.write(b"changed")
+        archiver.update(today)
+        os.remove(os.path.join(self.target, "places.sqlite"))
+        diff = archiver._get_diff_path(yesterday, today)
+        self.assertRaises(DeltaError, apply_diff, diff, self.target)
+
+    def test_get_profile_with_diffs(self):
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        self.archiver.update(yesterday)
+        downloads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, downloads)
+
+        with Server(self.archives_dir) as server:
+            args = Namespace(
+                scenarii="heavy",
+                archives_server=server.url,
+                archives_dir=downloads,
+                profile=self.target,
+            )
+            get_profile(args)
+            # the archive was kept while being extracted
+            cached = os.path.join(downloads, "heavy-latest.tar.gz")
+            self.assertTrue(os.path.exists(cached))
+            with open(os.path.join(self.profile_dir, "new.txt"), "w") as f:
+                f.write("new")
+            self.archiver.update(today)
+
+            del server.requests[:]
+            get_profile(args)
+            fetched = [path for command, path, __ in server.requests]
+
+        self.assertEqual(_read_dir(self.target), _read_dir(self.profile_dir))
+        self.assertTrue("/heavy-latest.tar.gz" not in fetched)
+        diff = os.path.basename(self.archiver._get_diff_path(yesterday, today))
+        self.assertTrue("/" + diff in fetched)
+
+    def test_get_profile_zstd(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, codec="zstd")
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        archiver.update(yesterday)
+        downloads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, downloads)
+
+        with Server(self.archives_dir) as server:
+            args = Namespace(
+                scenarii="heavy",
+                archives_server=server.url,
+                archives_dir=downloads,
+                profile=self.target,
+                codec="zstd",
+            )
+            get_profile(args)
+            os.remove(os.path.join(self.profile_dir, "user.js"))
+            archiver.update(today)
+            del server.requests[:]
+            get_profile(args)
+            fetched = [path for command, path, __ in server.requests]
+
+        self.assertEqual(_read_dir(self.target), _read_dir(self.profile_dir))
+        diff = os.path.basename(archiver._get_diff_path(yesterday, today))
+        self.assertTrue(diff.endswith(".tar.zst"))
+        self.assertTrue("/" + diff in fetched)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from argparse import Namespace
+from datetime import date
+
+from condprof.archiver import Archiver
+from condprof.client import get_profiles
+from condprof.clone import Cloner, _is_root
+from condprof.tests.support import Server
+from condprof.util import fresh_profile
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestClone(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = os.path.join(tempfile.mkdtemp(), "clone")
+        self.addCleanup(shutil.rmtree, self.source)
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.target))
+        os.mkdir(os.path.join(self.source, "sub"))
+        for name in ("prefs.js", "sub/cert9.db"):
+            with open(os.path.join(self.source, name), "w") as f:
+                f.write(name)
+        self.readonly = os.path.join(self.source, "sub", "omni.ja")
+        with open(self.readonly, "w") as f:
+            f.write("read only")
+        os.chmod(self.readonly, stat.S_IRUSR | stat.S_IRGRP)
+        os.symlink("prefs.js", os.path.join(self.source, "link.js"))
+
+    def test_clone(self):
+        cloner = Cloner()
+        cloner.clone(self.source, self.target)
+        self.assertEqual(cloner.reflinked + cloner.linked + cloner.copied, 3)
+        for name in ("prefs.js", "sub/cert9.db", "sub/omni.ja"):
+            self.assertEqual(
+                _read(os.path.join(self.target, name)),
+                _read(os.path.join(self.source, name)),
+            )
+        self.assertEqual(os.readlink(os.path.join(self.target, "link.js")), "prefs.js")
+
+        # writable files are never shared
+        with open(os.path.join(self.target, "prefs.js"), "w") as f:
+            f.write("changed")
+        self.assertEqual(_read(os.path.join(self.source, "prefs.js")), "prefs.js")
+
+        cloned = os.stat(os.path.join(self.target, "sub", "omni.ja"))
+        self.assertEqual(stat.S_IMODE(cloned.st_mode), stat.S_IRUSR | stat.S_IRGRP)
+        shared = cloned.st_ino == os.stat(self.readonly).st_ino
+        self.assertEqual(shared, cloner.linked == 1)
+
+    def test_no_reflinks(self):
+        cloner = Cloner(reflink=False)
+        cloner.clone(self.source, self.target)
+        self.assertEqual(cloner.reflinked, 0)
+        if _is_root():
+            self.assertEqual(cloner.copied, 3)
+        else:
+            self.assertEqual((cloner.linked, cloner.copied), (1, 2))
+
+    def test_get_profiles(self):
+        profile_dir = fresh_profile()
+        self.addCleanup(shutil.rmtree, os.path.dirname(profile_dir))
+        archives_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archives_dir)
+        Archiver(profile_dir, archives_dir).update(date.today())
+        root = os.path.dirname(self.target)
+        targets = [os.path.join(root, "job%d" % i) for i in range(3)]
+
+        with Server(archives_dir) as server:
+            args = Namespace(
+                scenarii="heavy",
+                archives_server=server.url,
+                archives_dir=tempfile.mkdtemp(),
+                profile=os.path.join(root, "template"),
+            )
+            self.addCleanup(shutil.rmtree, args.archives_dir)
+            self.assertEqual(get_profiles(args, targets), targets)
+            fetched = [path for command, path, __ in server.requests]
+
+        self.assertEqual(fetched.count("/heavy-latest.tar.gz"), 1)
+        for target in targets:
+            self.assertEqual(
+                _read(os.path.join(target, "prefs.js")),
+                _read(os.path.join(profile_dir, "prefs.js")),
+            )
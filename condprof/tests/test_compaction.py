@@ -0,0 +1,77 @@
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import unittest
+from datetime import date
+
+from condprof.archiver import Archiver
+from condprof.compaction import Rules, compact_database
+from condprof.util import fresh_profile
+
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+
+    def _db(self, journal_mode="delete"):
+        path = os.path.join(self.profile_dir, "places.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=%s" % journal_mode)
+        conn.execute("create table visits (url text)")
+        for i in range(5000):
+            conn.execute("insert into visits values (?)", ("http://%d" % i,))
+        conn.commit()
+        return path, conn
+
+    def test_rules(self):
+        rules = Rules(includes=("cache2/keep",))
+        self.assertTrue(rules.excluded("cache2"))
+        self.assertTrue(rules.excluded("cache2/entries/ABC"))
+        self.assertTrue(rules.excluded("places.sqlite-wal"))
+        self.assertFalse(rules.excluded("places.sqlite"))
+        self.assertFalse(rules.excluded("cache2/keep"))
+
+    def test_vacuum(self):
+        path, conn = self._db()
+        conn.execute("delete from visits where rowid > 100")
+        conn.commit()
+        conn.close()
+        size = os.path.getsize(path)
+        self.assertEqual(compact_database(path, vacuum=False), 0)
+        saved = compact_database(path)
+        self.assertTrue(saved > size / 2)
+        self.assertEqual(compact_database(path), 0)
+
+    def test_archive(self):
+        # the database content only lives in its write-ahead log
+        path, conn = self._db("wal")
+        os.makedirs(os.path.join(self.profile_dir, "cache2", "entries"))
+        with open(os.path.join(self.profile_dir, "cache2", "entries", "A"), "w") as f:
+            f.write("cached")
+        with open(os.path.join(self.profile_dir, "lock"), "w") as f:
+            f.write("")
+        self.assertTrue(os.path.getsize(path + "-wal") > 0)
+
+        archiver = Archiver(self.profile_dir, self.archives_dir, excludes=["user.js"])
+        archive = archiver.create_archive(date.today())
+        conn.close()
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        with tarfile.open(archive, "r:gz") as tar:
+            names = tar.getnames()
+            tar.extractall(target)
+        self.assertEqual(
+            sorted(names),
+            ["localstore.rdf", "permissions.sqlite", "places.sqlite", "prefs.js"],
+        )
+        conn = sqlite3.connect(os.path.join(target, "places.sqlite"))
+        count = conn.execute("select count(*) from visits").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 5000)
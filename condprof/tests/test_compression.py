@@ -0,0 +1,57 @@
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from condprof.compression import ParallelGzipWriter, open_archive
+
+
+try:
+    import zstandard  # NOQA
+except ImportError:
+    zstandard = None
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        os.mkdir(self.src)
+        for i in range(20):
+            with open(os.path.join(self.src, "file%d" % i), "wb") as f:
+                f.write(os.urandom(1024) * (i + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _roundtrip(self, archive, **options):
+        with open_archive(archive, "w", **options) as tar:
+            tar.add(self.src, "src")
+        with open_archive(archive) as tar:
+            for tarinfo in tar:
+                if not tarinfo.isfile():
+                    continue
+                with open(os.path.join(self.tmp, tarinfo.name), "rb") as f:
+                    self.assertEqual(tar.extractfile(tarinfo).read(), f.read())
+
+    def test_parallel_gzip_members(self):
+        data = os.urandom(1024) * 1000
+        out = io.BytesIO()
+        writer = ParallelGzipWriter(out, level=1, workers=4, block_size=64 * 1024)
+        writer.write(data)
+        writer.close()
+        self.assertEqual(gzip.decompress(out.getvalue()), data)
+
+    def test_parallel_gzip_archive(self):
+        archive = os.path.join(self.tmp, "archive.tar.gz")
+        self._roundtrip(archive, workers=4)
+        # plain tarfile can read it
+        with tarfile.open(archive, "r:gz") as tar:
+            self.assertEqual(len(tar.getmembers()), 21)
+
+    @unittest.skipIf(zstandard is None, "needs zstandard")
+    def test_zstd_archive(self):
+        self._roundtrip(os.path.join(self.tmp, "archive.tar.zst"), workers=2)
@@ -0,0 +1,75 @@
+import io
+import unittest
+
+from condprof.diffinfo import Change, DiffInfo, DiffInfoError, iter_changes
+from condprof.manifest import Entry
+
+
+def _entry(name, size=10, mtime=1, digest="a", type="0"):
+    return Entry(name, type, size, mtime, 0o644, digest, 0)
+
+
+class TestDiffInfo(unittest.TestCase):
+    def setUp(self):
+        self.previous = {
+            "same": _entry("same"),
+            "touched": _entry("touched"),
+            "rewritten": _entry("rewritten"),
+            "dir": _entry("dir", size=0, digest=None, type="5"),
+            "gone": _entry("gone"),
+        }
+        self.current = {
+            "same": _entry("same"),
+            "touched": _entry("touched", mtime=2),
+            "rewritten": _entry("rewritten", digest="b"),
+            "dir": _entry("dir", size=0, mtime=2, digest=None, type="5"),
+            "new": _entry("new"),
+        }
+
+    def _update(self, comparison):
+        diff = DiffInfo(comparison)
+        entries = diff.update(self.current, self.previous)
+        return diff, sorted(entry.name for entry in entries)
+
+    def test_exact(self):
+        diff, names = self._update("exact")
+        self.assertEqual(names, ["new", "rewritten"])
+        self.assertEqual((diff.new, diff.changed, diff.deleted), (1, 1, 1))
+
+    def test_fast(self):
+        diff, names = self._update("fast")
+        # same-size rewrites with the same mtime are missed
+        self.assertEqual(names, ["dir", "new", "touched"])
+
+    def test_dump_load(self):
+        diff, __ = self._update("exact")
+        diff.add_changed("with:colon\nand newline", 3)
+        loaded = DiffInfo()
+        loaded.load(io.BytesIO(diff.dump()))
+        self.assertEqual(list(loaded), list(diff))
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual(str(loaded), str(diff))
+        self.assertEqual(list(iter_changes(io.BytesIO(diff.dump()))), list(diff))
+        entries = {entry.name: entry for entry in iter_changes(diff.dump())}
+        self.assertEqual(entries["new"], (Change.NEW, "new", 10, "a"))
+        self.assertEqual(entries["gone"], (Change.DELETED, "gone", None, None))
+        self.assertEqual(entries["with:colon\nand newline"].size, 3)
+
+    def test_truncated(self):
+        diff, __ = self._update("exact")
+        with self.assertRaises(DiffInfoError):
+            DiffInfo().load(diff.dump()[:-1])
+
+    def test_legacy(self):
+        diff = DiffInfo()
+        diff.load(b"NEW:new\nCHANGED:a:b\n\nDELETED:gone\nDELTA:places.sqlite")
+        self.assertEqual(
+            [(entry.change, entry.name) for entry in diff],
+            [
+                (Change.NEW, "new"),
+                (Change.CHANGED, "a:b"),
+                (Change.DELETED, "gone"),
+                (Change.DELTA, "places.sqlite"),
+            ],
+        )
+        self.assertEqual((diff.new, diff.changed, diff.deleted, diff.patched), (1,) * 4)
@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import time
+import unittest
+
+from condprof.scenario.heavy import corpus_size, iter_urls, load_concurrently
+from condprof.scenario.navigation import NavigationPolicy, TabSwitcher
+
+
+class FakeSession(object):
+    """Tabs take as many polls to load as their url says."""
+
+    def __init__(self, tabs):
+        self.handles = ["tab-%d" % i for i in range(tabs)]
+        self.current = None
+        self.loading = {}
+        self.max_loading = 0
+
+    async def get_window_handles(self):
+        return self.handles
+
+    async def switch_to_window(self, handle):
+        self.current = handle
+
+    async def execute_script(self, script, *args):
+        if args:
+            self.loading[self.current] = int(args[0].split("/")[-1])
+            self.max_loading = max(self.max_loading, len(self.loading))
+            return None
+        self.loading[self.current] -= 1
+        if self.loading[self.current] > 0:
+            return False
+        del self.loading[self.current]
+        return True
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestHeavy(unittest.TestCase):
+    def test_load_concurrently(self):
+        session = FakeSession(10)
+        urls = ["http://example.com/%d" % (i % 3 + 1) for i in range(20)]
+        policy = NavigationPolicy(per_host=10)
+        coro = load_concurrently(session, TabSwitcher(session), urls, 20, 4, policy)
+        visited = _run(coro)
+        self.assertEqual(visited, 20)
+        self.assertEqual(session.max_loading, 4)
+
+    def test_per_host_limit(self):
+        session = FakeSession(10)
+        urls = ["http://%s.com/2" % host for host in "aaaaaab"]
+        policy = NavigationPolicy(per_host=2)
+        coro = load_concurrently(session, TabSwitcher(session), urls, 7, 10, policy)
+        self.assertEqual(_run(coro), 7)
+        self.assertEqual(session.max_loading, 3)
+
+    def test_timeouts(self):
+        session = FakeSession(2)
+        urls = ["http://example.com/1", "http://example.com/1000"]
+        policy = NavigationPolicy(timeout=0.1, retry_delay=0)
+        coro = load_concurrently(session, TabSwitcher(session), urls, 2, 2, policy)
+        self.assertEqual(_run(coro), 1)
+        self.assertTrue(policy.stats()["example.com"]["skipped"])
+
+    def test_skipped_hosts_are_deferred(self):
+        session = FakeSession(2)
+        urls = ["http://a.com/1000", "http://a.com/1", "http://a.com/1"]
+        urls.append("http://b.com/1")
+        policy = NavigationPolicy(
+            timeout=0.1,
+            per_host=1,
+            retries=2,
+            retry_delay=0,
+            max_failures=1,
+            backoff=0.3,
+        )
+        coro = load_concurrently(session, TabSwitcher(session), urls, 4, 2, policy)
+        # the urls of a.com are loaded once it's not skipped anymore
+        self.assertEqual(_run(coro), 3)
+
+    def test_iter_urls(self):
+        first = list(itertools.islice(iter_urls(42), 100))
+        self.assertEqual(first, list(itertools.islice(iter_urls(42), 100)))
+        self.assertNotEqual(first, list(itertools.islice(iter_urls(43), 100)))
+        # every url of the corpus, once
+        urls = list(iter_urls(42))
+        self.assertEqual(len(urls), corpus_size())
+        self.assertEqual(len(set(urls)), corpus_size())
+
+
+class TestNavigationPolicy(unittest.TestCase):
+    def test_adaptive_timeout(self):
+        policy = NavigationPolicy(timeout=5, min_timeout=1, max_timeout=15)
+        url = "http://example.com/"
+        self.assertEqual(policy.timeout(url), 5)
+        for latency in (0.1, 0.2, 0.2, 0.3, 1.5):
+            policy.started(url)
+            policy.succeeded(url, latency)
+        self.assertEqual(policy.timeout(url), 1)
+        for latency in (6, 7, 8, 9, 10):
+            policy.started(url)
+            policy.succeeded(url, latency)
+        self.assertEqual(policy.timeout(url), 15)
+        # other hosts are not affected
+        self.assertEqual(policy.timeout("http://example.org/"), 5)
+
+    def test_backoff(self):
+        policy = NavigationPolicy(max_failures=2, backoff=10, max_backoff=15)
+        url = "http://example.com/"
+        for i in range(2):
+            self.assertTrue(policy.available(url))
+            policy.started(url)
+            policy.failed(url)
+        self.assertTrue(policy.skipped(url))
+        self.assertFalse(policy.available(url))
+        skip_until = policy._host(url).skip_until
+        self.assertTrue(9 < skip_until - time.monotonic() <= 10)
+        policy.started(url)
+        policy.failed(url)
+        skip_until = policy._host(url).skip_until
+        self.assertTrue(14 < skip_until - time.monotonic() <= 15)
+        self.assertEqual([policy.delay(i) for i in range(4)], [0, 1, 2, 4])
@@ -0,0 +1,44 @@
+import io
+import unittest
+
+from condprof import reporting
+
+
+class TestReporting(unittest.TestCase):
+    def tearDown(self):
+        reporting.disable()
+
+    def test_hidden(self):
+        reporting.disable()
+        with reporting.task("archive", files=10) as task:
+            task.add(files=1, bytes=10)
+        self.assertTrue(task is reporting._NULL_TASK)
+
+    def test_rate_limited(self):
+        stream = io.StringIO()
+        reporting.enable(stream, refresh=3600)
+        with reporting.task("archive", files=100000) as task:
+            for i in range(100000):
+                task.add(files=1, bytes=1024)
+        output = stream.getvalue()
+        # the first update, then the final status
+        self.assertEqual(output.count("\r"), 2)
+        last = output.split("\r")[-1]
+        self.assertTrue(last.startswith("archive 100000/100000 files 97.7 MB"))
+        self.assertTrue("MB/s" in last)
+        self.assertTrue(last.endswith("\n"))
+
+    def test_concurrent_tasks(self):
+        stream = io.StringIO()
+        reporter = reporting.enable(stream, refresh=0)
+        download = reporting.start("download", bytes=2 * 1024 * 1024)
+        with reporting.task("extract") as extract:
+            download.add(bytes=1024 * 1024)
+            extract.add(files=3)
+            self.assertEqual(len(reporter.tasks), 2)
+            line = stream.getvalue().split("\r")[-1]
+            self.assertTrue(line.startswith("download 1.0/2.0 MB"))
+            self.assertTrue("ETA" in line)
+            self.assertTrue(line.strip().endswith("| extract 3 files"))
+        download.done()
+        self.assertEqual(reporter.tasks, [])
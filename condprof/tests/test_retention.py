@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from argparse import Namespace
+from datetime import date, timedelta
+
+from condprof.archiver import Archiver
+from condprof.client import get_profile
+from condprof.retention import RetentionPolicy
+from condprof.tests.support import Server
+from condprof.util import fresh_profile
+
+
+def _touch(path, data="data"):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        self.archiver = Archiver(
+            self.profile_dir,
+            self.archives_dir,
+            retention=RetentionPolicy(dailies=3, weeklies=0),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+        shutil.rmtree(self.target)
+
+    def test_policy(self):
+        # a Sunday
+        today = date(2019, 6, 30)
+        dates = [today - timedelta(days=i) for i in range(40) if i != 7]
+        keep = RetentionPolicy(dailies=3, weeklies=3).keep(dates)
+        wanted = [
+            today,
+            today - timedelta(days=1),
+            today - timedelta(days=2),
+            # last of the previous week, since that Sunday is missing
+            today - timedelta(days=8),
+            today - timedelta(days=14),
+        ]
+        self.assertEqual(sorted(keep), sorted(wanted))
+
+    def test_collect_garbage(self):
+        start = date.today() - timedelta(days=6)
+        for i in range(6):
+            when = start + timedelta(days=i)
+            archive, __ = self.archiver._get_archive_path(when)
+            _touch(self.profile_dir + "/day.txt", str(i))
+            if i == 0:
+                _touch(archive + ".sha256")
+                _touch(archive + ".asc")
+            self.archiver.update(when)
+
+        kept = [start + timedelta(days=i) for i in (3, 4, 5)]
+        wanted = ["heavy-latest.tar.gz", "heavy-latest.tar.gz.manifest"]
+        for day in kept:
+            wanted.append(day.strftime("heavy-%Y-%m-%d-hp.tar.gz"))
+            wanted.append(day.strftime("heavy-%Y-%m-%d-hp.tar.gz.manifest"))
+        for day in kept[:2]:
+            path = self.archiver._get_diff_path(day, kept[-1])
+            wanted.append(os.path.basename(path))
+        self.assertEqual(sorted(os.listdir(self.archives_dir)), sorted(wanted))
+        latest = os.path.join(self.archives_dir, "heavy-latest.tar.gz")
+        self.assertTrue(os.path.exists(latest))
+
+    def test_squashed_diff(self):
+        today = date.today()
+        _2_days_ago = today - timedelta(days=2)
+        self.archiver.update(_2_days_ago)
+        downloads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, downloads)
+
+        with Server(self.archives_dir) as server:
+            args = Namespace(
+                scenarii="heavy",
+                archives_server=server.url,
+                archives_dir=downloads,
+                profile=self.target,
+            )
+            get_profile(args)
+            _touch(os.path.join(self.profile_dir, "new.txt"))
+            self.archiver.update(today - timedelta(days=1))
+            os.remove(os.path.join(self.profile_dir, "new.txt"))
+            _touch(os.path.join(self.profile_dir, "other.txt"))
+            self.archiver.update(today)
+
+            del server.requests[:]
+            get_profile(args)
+            fetched = [path for command, path, __ in server.requests]
+
+        squashed = self.archiver._get_diff_path(_2_days_ago, today)
+        self.assertTrue("/" + os.path.basename(squashed) in fetched)
+        self.assertTrue("/heavy-latest.tar.gz" not in fetched)
+        self.assertFalse(os.path.exists(os.path.join(self.target, "new.txt")))
+        self.assertTrue(os.path.exists(os.path.join(self.target, "other.txt")))
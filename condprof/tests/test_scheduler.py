@@ -0,0 +1,39 @@
+import os
+import unittest
+from argparse import Namespace
+
+from condprof.scheduler import get_jobs, get_max_workers, run_jobs
+
+
+def _job(args):
+    if args.customization == "broken":
+        raise ValueError(args.scenarii)
+    return os.getpid(), args.profile
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.args = Namespace(profile="/tmp/profile", log_dir="/tmp/logs")
+
+    def test_jobs(self):
+        jobs = get_jobs(self.args, ["heavy", "cold"], ["vanilla", "themed"])
+        self.assertEqual(len(jobs), 4)
+        profiles = set(job.profile for job in jobs)
+        self.assertEqual(len(profiles), 4)
+        self.assertTrue("/tmp/profile/cold-themed" in profiles)
+        self.assertEqual(len(set(job.gecko_log for job in jobs)), 4)
+        # a single job uses the profile dir
+        jobs = get_jobs(self.args, ["heavy"], ["vanilla"])
+        self.assertEqual(jobs[0].profile, "/tmp/profile")
+        self.assertTrue(get_max_workers() >= 1)
+
+    def test_run_jobs(self):
+        jobs = get_jobs(self.args, ["heavy", "cold"], ["vanilla"])
+        results = run_jobs(_job, jobs, max_workers=2)
+        self.assertEqual(
+            [profile for __, profile in results], [j.profile for j in jobs]
+        )
+        self.assertTrue(os.getpid() not in [pid for pid, __ in results])
+
+        jobs = get_jobs(self.args, ["heavy", "cold"], ["broken"])
+        self.assertRaises(ValueError, run_jobs, _job, jobs, 2)
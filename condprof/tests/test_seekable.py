@@ -0,0 +1,92 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from argparse import Namespace
+from datetime import date
+
+from condprof.archiver import Archiver
+from condprof.client import get_files
+from condprof.manifest import Manifest, get_manifest_path
+from condprof.seekable import extract_members
+from condprof.tests.support import Server
+from condprof.util import fresh_profile
+
+
+class TestSeekable(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.profile_dir, "sub"))
+        for i in range(3):
+            path = os.path.join(self.profile_dir, "sub", "big%d.bin" % i)
+            with open(path, "wb") as f:
+                f.write(os.urandom(1024 * 1024))
+        # long names go through pax headers
+        self.long_name = "sub/" + "x" * 150
+        with open(os.path.join(self.profile_dir, self.long_name), "w") as f:
+            f.write("long")
+        # way past what an estimate of the header size would allow
+        self.deep_name = "sub/" + "/".join(["\u00e9" * 120] * 8) + "/deep.txt"
+        path = os.path.join(self.profile_dir, self.deep_name)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("deep" * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+        shutil.rmtree(self.target)
+
+    def _read(self, root, name):
+        with open(os.path.join(root, name), "rb") as f:
+            return f.read()
+
+    def test_extract_members(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, seekable=True)
+        archive = archiver.create_archive(date.today())
+        manifest = Manifest.load(get_manifest_path(archive))
+        self.assertTrue(len(manifest.info["frames"]) > 12)
+
+        # still a regular tarball
+        with tarfile.open(archive, "r:gz") as tar:
+            self.assertTrue("sub/big2.bin" in tar.getnames())
+            for tarinfo in tar:
+                entry = manifest[tarinfo.name]
+                self.assertEqual(entry.data_offset, tarinfo.offset_data)
+
+        names = ["prefs.js", self.long_name, self.deep_name]
+        read = extract_members(archive, manifest, names, self.target)
+        self.assertTrue(read < os.path.getsize(archive) / 4)
+        for name in names:
+            self.assertEqual(
+                self._read(self.target, name), self._read(self.profile_dir, name)
+            )
+        self.assertFalse(os.path.exists(os.path.join(self.target, "user.js")))
+
+    def test_get_files(self):
+        archiver = Archiver(self.profile_dir, self.archives_dir, seekable=True)
+        archiver.update(date.today())
+        downloads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, downloads)
+        with Server(self.archives_dir) as server:
+            args = Namespace(
+                scenarii="heavy",
+                archives_server=server.url,
+                archives_dir=downloads,
+                profile=self.target,
+            )
+            self.assertTrue(get_files(args, ["sub/big1.bin"]))
+            ranges = [
+                req[2]["Range"]
+                for req in server.requests
+                if req[1] == "/heavy-latest.tar.gz" and "Range" in req[2]
+            ]
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(
+            self._read(self.target, "sub/big1.bin"),
+            self._read(self.profile_dir, "sub/big1.bin"),
+        )
+        self.assertEqual(os.listdir(self.target), ["sub"])
@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+from condprof import tracing
+from condprof.archiver import Archiver
+from condprof.tracing import span
+from condprof.util import fresh_profile
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = fresh_profile()
+        self.archives_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tracing.disable()
+        shutil.rmtree(self.profile_dir)
+        shutil.rmtree(self.archives_dir)
+
+    def test_disabled(self):
+        with span("phase") as s:
+            s.add(bytes=10)
+        self.assertEqual(tracing.get_tracer(), None)
+
+    def test_archiver_phases(self):
+        tracer = tracing.enable()
+        archiver = Archiver(self.profile_dir, self.archives_dir)
+        today = date.today()
+        archiver.update(today - timedelta(days=1))
+        with open(os.path.join(self.profile_dir, "new.txt"), "w") as f:
+            f.write("new")
+        archiver.update(today)
+
+        trace = os.path.join(self.archives_dir, "trace.json")
+        tracer.export(trace)
+        with open(trace) as f:
+            events = json.loads(f.read())["traceEvents"]
+        names = [event["name"] for event in events]
+        # the diff is written with the second archive
+        self.assertEqual(names.count("create_archive"), 2)
+        self.assertEqual(names.count("update_symlinks"), 2)
+        first, second = [e for e in events if e["name"] == "create_archive"]
+        self.assertTrue(first["args"]["bytes"] > 0)
+        self.assertTrue(first["args"]["files"] > 0)
+        self.assertTrue(second["args"]["diff_bytes"] > 0)
+
+        summary = tracer.summary().splitlines()
+        self.assertTrue(summary[0].startswith("phase"))
+        self.assertEqual(len(summary), 1 + len(set(names)))
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from condprof import util
+from condprof.util import download_file, unpack_archive, ArchiveError, ArchiveNotFound
+from condprof.tests.support import Server
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.target_dir = tempfile.mkdtemp()
+        self.data = os.urandom(1024 * 1024)
+        with open(os.path.join(self.root, "file.bin"), "wb") as f:
+            f.write(self.data)
+        self.target = os.path.join(self.target_dir, "file.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.target_dir)
+
+    def _content(self):
+        with open(self.target, "rb") as f:
+            return f.read()
+
+    def test_conditional_download(self):
+        with Server(self.root) as server:
+            url = server.url + "/file.bin"
+            download_file(url, self.target)
+            self.assertEqual(self._content(), self.data)
+            del server.requests[:]
+            download_file(url, self.target)
+            # a single conditional GET, answered with a 304
+            self.assertEqual(len(server.requests), 1)
+            self.assertTrue("If-None-Match" in server.requests[0][2])
+
+    def test_single_request(self):
+        with Server(self.root) as server:
+            download_file(server.url + "/file.bin", self.target)
+            gets = [req for req in server.requests if req[0] == "GET"]
+        self.assertEqual(len(gets), 1)
+        self.assertEqual(self._content(), self.data)
+
+    @mock.patch.object(util, "SEGMENT_SIZE", 100 * 1024)
+    def test_segments(self):
+        with Server(self.root) as server:
+            download_file(server.url + "/file.bin", self.target)
+            ranges = [req for req in server.requests if "Range" in req[2]]
+        self.assertEqual(len(ranges), util.MAX_SEGMENTS)
+        self.assertEqual(self._content(), self.data)
+        self.assertFalse(os.path.exists(self.target + ".part.json"))
+
+    def test_resume(self):
+        stat = os.stat(os.path.join(self.root, "file.bin"))
+        etag = '"%d-%d"' % (stat.st_mtime_ns, stat.st_size)
+        half = len(self.data) // 2
+        with open(self.target + ".part", "wb") as f:
+            f.write(self.data[:half])
+        state = {"etag": etag, "size": len(self.data)}
+        state["segments"] = [[0, len(self.data) - 1, half]]
+        with open(self.target + ".part.json", "w") as f:
+            f.write(json.dumps(state))
+
+        with Server(self.root) as server:
+            download_file(server.url + "/file.bin", self.target)
+            ranges = [req[2]["Range"] for req in server.requests if "Range" in req[2]]
+        self.assertEqual(ranges, ["bytes=%d-%d" % (half, len(self.data) - 1)])
+        self.assertEqual(self._content(), self.data)
+
+    def test_checksum(self):
+        with open(os.path.join(self.root, "file.bin.sha256"), "w") as f:
+            f.write(hashlib.sha256(b"something else").hexdigest())
+        with Server(self.root) as server:
+            url = server.url + "/file.bin"
+            self.assertRaises(ArchiveError, download_file, url, self.target, True)
+            self.assertRaises(
+                ArchiveNotFound, download_file, url + "-nope", self.target
+            )
+
+    def test_unpack_archive(self):
+        for compression in ("bz2", "xz"):
+            archive = os.path.join(self.root, "firefox.tar." + compression)
+            with tarfile.open(archive, "w:" + compression) as tar:
+                tar.add(os.path.join(self.root, "file.bin"), "firefox/file.bin")
+            for threaded in (True, False):
+                target = tempfile.mkdtemp()
+                self.addCleanup(shutil.rmtree, target)
+                with Server(self.root) as server:
+                    url = server.url + "/firefox.tar." + compression
+                    unpack_archive(url, target, threaded=threaded)
+                self.assertEqual(os.listdir(target), ["firefox"])
+                with open(os.path.join(target, "firefox", "file.bin"), "rb") as f:
+                    self.assertEqual(f.read(), self.data)
@@ -0,0 +1,121 @@
+"""Phase timings of the creator and archiver.
+
+Phases are wrapped in spans, which also count the bytes and files they
+process::
+
+    with span("create_archive") as s:
+        ...
+        s.add(bytes=size, files=1)
+
+Spans cost nothing until enable() is called. The recorded spans can then
+be exported in the Chrome trace format (chrome://tracing, Perfetto) and
+summed up in a table.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.args[name] = self.args.get(name, 0) + value
+
+
+class Tracer(object):
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def record(self, span):
+        span.duration = time.perf_counter() - span.start
+        span.tid = threading.get_ident()
+        with self._lock:
+            self.spans.append(span)
+
+    def export(self, path):
+        """Writes the spans as a Chrome trace file."""
+        events = []
+        for span in self.spans:
+            event = {
+                "name": span.name,
+                "ph": "X",
+                "ts": int((span.start - self._origin) * 1e6),
+                "dur": int(span.duration * 1e6),
+                "pid": os.getpid(),
+                "tid": span.tid,
+                "args": span.args,
+            }
+            events.append(event)
+        with open(path, "w") as f:
+            f.write(json.dumps({"traceEvents": events}))
+
+    def summary(self):
+        """Returns a table with the count, time and throughput of each phase."""
+        phases = {}
+        for span in self.spans:
+            phase = phases.setdefault(span.name, [0, 0.0, 0, 0])
+            phase[0] += 1
+            phase[1] += span.duration
+            phase[2] += span.args.get("bytes", 0)
+            phase[3] += span.args.get("files", 0)
+        lines = ["%-20s %6s %10s %10s %8s %10s" % _HEADER]
+        for name, (count, duration, size, files) in phases.items():
+            rate = "-"
+            if size and duration:
+                rate = "%.1f" % (size / duration / 1024 / 1024)
+            lines.append(
+                "%-20s %6d %10.2f %10.1f %8d %10s"
+                % (name, count, duration, size / 1024 / 1024, files, rate)
+            )
+        return "\n".join(lines)
+
+
+_HEADER = ("phase", "count", "seconds", "MB", "files", "MB/s")
+_tracer = None
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer():
+    return _tracer
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Records the time spent in the block, when tracing is enabled."""
+    tracer = _tracer
+    if tracer is None:
+        yield _NULL_SPAN
+        return
+    current = Span(name, args)
+    try:
+        yield current
+    finally:
+        tracer.record(current)
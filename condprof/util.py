@@ -1,16 +1,28 @@
+import bz2
+import lzma
 import platform
+import tarfile
 import time
 import os
 import tempfile
-import shutil
 import contextlib
+import functools
+import glob
 import json
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 
-from condprof import progress
-from condprof import logger
+from condprof import logger, reporting
+from condprof.tracing import span
+from condprof.cache import ArtifactCache
+from condprof.clone import Cloner
+from condprof.hashing import file_digest
 
 
 _BASE_PROFILE = os.path.join(os.path.dirname(__file__), "base_profile")
@@ -28,8 +40,12 @@ class ArchiveError(Exception):
 def fresh_profile(target_dir=None, name="heavy"):
     if target_dir is None:
         target_dir = os.path.join(tempfile.mkdtemp(), "profile")
-    shutil.copytree(_BASE_PROFILE, target_dir)
-    with open(os.path.join(target_dir, ".hp.json"), "w") as f:
+    Cloner().clone(_BASE_PROFILE, target_dir)
+    metadata_file = os.path.join(target_dir, ".hp.json")
+    # never write through a link shared with the base profile
+    if os.path.exists(metadata_file):
+        os.remove(metadata_file)
+    with open(metadata_file, "w") as f:
         f.write(json.dumps({"name": name}))
 
     return target_dir
@@ -62,11 +78,32 @@ def get_firefox_download_link():
     raise Exception()
 
 
+# downloads are written in chunks of that size
+CHUNK_SIZE = 1024 * 1024
+# files bigger than that are fetched with several parallel range requests
+SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SEGMENTS = 4
+# how many chunks a stream can download ahead of its reader
+STREAM_AHEAD = 16
+_SESSION = None
+
+
+def get_session():
+    """Returns a requests session shared by all downloads."""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_SEGMENTS)
+        _SESSION.mount("http://", adapter)
+        _SESSION.mount("https://", adapter)
+    return _SESSION
+
+
 def check_exists(archive, server=None):
     if server is not None:
         archive = server + "/" + archive
     try:
-        resp = requests.head(archive)
+        resp = get_session().head(archive)
     except ConnectionError:
         return False, {}
 
@@ -75,91 +112,409 @@ def check_exists(archive, server=None):
     return resp.status_code == 200, resp.headers
 
 
-def download_file(url, target=None):
-    present, headers = check_exists(url)
-    if not present:
-        logger.msg("Cannot find %r" % url)
+def _read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def _write(path, data):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+class _Download(object):
+    """Fetches a file with parallel range requests into target.part.
+
+    The progress of each segment is saved in target.part.json so an
+    interrupted download can be resumed, as long as the ETag and size of
+    the file did not change.
+    """
+
+    def __init__(self, url, target, size, etag, segments=MAX_SEGMENTS):
+        self.url = url
+        self.part = target + ".part"
+        self.state_file = self.part + ".json"
+        self.size = size
+        self.etag = etag
+        self._lock = threading.Lock()
+        state = _read(self.state_file)
+        if state is not None and os.path.exists(self.part):
+            state = json.loads(state)
+            if state["etag"] == etag and state["size"] == size:
+                self.segments = state["segments"]
+                logger.msg("Resuming download of %s" % url)
+                return
+        count = max(1, min(segments, size // SEGMENT_SIZE))
+        step = size // count + 1
+        # [start, end, bytes done] for each segment
+        self.segments = [
+            [start, min(start + step, size) - 1, 0] for start in range(0, size, step)
+        ]
+
+    def _save(self):
+        with self._lock:
+            state = {"etag": self.etag, "size": self.size, "segments": self.segments}
+            _write(self.state_file, json.dumps(state))
+
+    def _fetch(self, fd, segment, task):
+        start, end, done = segment
+        if start + done > end:
+            return
+        headers = {"Range": "bytes=%d-%d" % (start + done, end)}
+        if self.etag is not None:
+            headers["If-Range"] = self.etag
+        with get_session().get(self.url, headers=headers, stream=True) as resp:
+            if resp.status_code != 206:
+                raise ArchiveError("%s changed during the download" % self.url)
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                os.pwrite(fd, chunk, start + segment[2])
+                segment[2] += len(chunk)
+                with self._lock:
+                    task.add(bytes=len(chunk))
+
+    def run(self):
+        mode = os.O_WRONLY | os.O_CREAT
+        fd = os.open(self.part, mode, 0o644)
+        task = reporting.start("download", bytes=self.size)
+        try:
+            os.ftruncate(fd, self.size)
+            task.add(bytes=sum(segment[2] for segment in self.segments))
+            with ThreadPoolExecutor(max_workers=len(self.segments)) as executor:
+                jobs = [
+                    executor.submit(self._fetch, fd, segment, task)
+                    for segment in self.segments
+                ]
+                for job in jobs:
+                    job.result()
+        except BaseException:
+            self._save()
+            raise
+        finally:
+            os.close(fd)
+            task.done()
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        return self.part
+
+
+def _stream(resp, target):
+    part = target + ".part"
+    size = resp.headers.get("content-length")
+    if size is not None:
+        size = int(size)
+    with open(part, "wb") as f, reporting.task("download", bytes=size) as task:
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+            task.add(bytes=len(chunk))
+    return part
+
+
+class _StreamReader(object):
+    """File-like object reading chunks produced by a background thread.
+
+    The thread pulls the chunks (e.g. from an HTTP response) and writes
+    them to tee if given, so the network and the reader's work overlap.
+    """
+
+    def __init__(self, chunks, size=None, tee=None, label="download"):
+        self._chunks = chunks
+        self._tee = tee
+        self._queue = queue.Queue(maxsize=STREAM_AHEAD)
+        self._buffer = bytearray()
+        self._eof = False
+        self._closed = False
+        self._task = reporting.start(label, bytes=size)
+        self._thread = threading.Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _pump(self):
+        try:
+            for chunk in self._chunks:
+                if self._closed:
+                    return
+                if self._tee is not None:
+                    self._tee.write(chunk)
+                self._put(chunk)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self._buffer += item
+                self._task.add(bytes=len(item))
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def drain(self):
+        """Reads whatever is left, so tee gets the whole content."""
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        self._task.done()
+
+
+@contextlib.contextmanager
+def stream_file(url, target=None):
+    """Yields a file-like object reading url while it's downloaded.
+
+    When target is given, the content is also written there, and if
+    target is already up to date (same ETag) it is read from disk instead.
+    """
+    headers = {}
+    etag_file = None
+    if target is not None:
+        etag_file = target + ".etag"
+        current_etag = _read(etag_file)
+        if os.path.exists(target) and current_etag is not None:
+            headers["If-None-Match"] = current_etag
+
+    try:
+        resp = get_session().get(url, headers=headers, stream=True)
+    except ConnectionError:
         raise ArchiveNotFound(url)
 
-    etag = headers.get("ETag")
+    with resp:
+        if resp.status_code == 304:
+            logger.msg("Already Downloaded")
+            with open(target, "rb") as f:
+                chunks = iter(functools.partial(f.read, CHUNK_SIZE), b"")
+                reader = _StreamReader(chunks, os.path.getsize(target), label="read")
+                try:
+                    yield reader
+                finally:
+                    reader.close()
+            return
+        if resp.status_code != 200:
+            logger.msg("Cannot find %r" % url)
+            raise ArchiveNotFound(url)
+
+        size = resp.headers.get("content-length")
+        if size is not None:
+            size = int(size)
+        tee = None
+        if target is not None:
+            target_dir = os.path.dirname(target)
+            if target_dir != "" and not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+            tee = open(target + ".part", "wb")
+
+        logger.msg("Streaming %s" % url)
+        reader = _StreamReader(resp.iter_content(chunk_size=CHUNK_SIZE), size, tee)
+        try:
+            yield reader
+            if tee is not None:
+                reader.drain()
+        except BaseException:
+            reader.close()
+            if tee is not None:
+                tee.close()
+                os.remove(target + ".part")
+            raise
+
+        reader.close()
+        if tee is not None:
+            tee.close()
+            os.replace(target + ".part", target)
+            etag = resp.headers.get("ETag")
+            if etag is not None:
+                _write(etag_file, etag)
+            elif os.path.exists(etag_file):
+                os.remove(etag_file)
+
+
+def download_file(url, target=None, check_file=False):
+    """Downloads url to target unless the local copy is up to date.
+
+    A single conditional GET (If-None-Match with the stored ETag) is used
+    to check for changes. When the server supports range requests the file
+    is fetched with several parallel segments, and partial downloads are
+    resumed. With check_file, the result is verified against the .sha256
+    file published next to url.
+    """
     if target is None:
         target = url.split("/")[-1]
-
+    etag_file = target + ".etag"
+    headers = {}
     if os.path.exists(target):
-        if etag is not None:
-            if os.path.exists(target + ".etag"):
-                with open(target + ".etag") as f:
-                    current_etag = f.read()
-                if etag == current_etag:
-                    logger.msg("Already Downloaded")
-                    # should at least check the size?
-                    return target
+        current_etag = _read(etag_file)
+        if current_etag is not None:
+            headers["If-None-Match"] = current_etag
 
-        logger.msg("Changed!")
+    session = get_session()
+    try:
+        resp = session.get(url, headers=headers, stream=True)
+    except ConnectionError:
+        resp = None
+    if resp is not None and resp.status_code == 304:
+        resp.close()
+        logger.msg("Already Downloaded")
+        return target
+    if resp is None or resp.status_code != 200:
+        logger.msg("Cannot find %r" % url)
+        raise ArchiveNotFound(url)
 
-    logger.msg("Downloading %s" % url)
-    req = requests.get(url, stream=True)
-    total_length = int(req.headers.get("content-length"))
     target_dir = os.path.dirname(target)
     if target_dir != "" and not os.path.exists(target_dir):
         os.makedirs(target_dir)
-    with open(target, "wb") as f:
-        if TASK_CLUSTER:
-            for chunk in req.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
-        else:
-            iter = req.iter_content(chunk_size=1024)
-            size = total_length / 1024 + 1
-            for chunk in progress.bar(iter, expected_size=size):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
 
+    logger.msg("Downloading %s" % url)
+    etag = resp.headers.get("ETag")
+    size = resp.headers.get("content-length")
+    with resp, span("download", url=url.split("/")[-1]) as s:
+        # parallel segments are worth a second request, and so is a resume
+        ranges = resp.headers.get("Accept-Ranges") == "bytes" and size is not None
+        segmented = ranges and int(size) >= 2 * SEGMENT_SIZE
+        if segmented or (ranges and os.path.exists(target + ".part.json")):
+            resp.close()
+            part = _Download(url, target, int(size), etag).run()
+        else:
+            part = _stream(resp, target)
+        s.add(bytes=os.path.getsize(part), files=1)
+
+    if check_file:
+        checksum = session.get(url + ".sha256")
+        if checksum.status_code == 200:
+            expected = checksum.text.split()[0]
+            if expected != file_digest(part):
+                logger.msg("Bad checksum!")
+                os.remove(part)
+                raise ArchiveError(target)
+
+    os.replace(part, target)
     if etag is not None:
-        with open(target + ".etag", "w") as f:
-            f.write(etag)
-
-    if check_file and check != signer.checksum(target):
-        logger.msg("Bad checksum!")
-        raise ArchiveError(target)
+        _write(etag_file, etag)
+    elif os.path.exists(etag_file):
+        os.remove(etag_file)
 
     return target
 
 
-@contextlib.contextmanager
-def latest_nightly(binary=None):
-    if binary is None:
-        # we want to use the latest nightly
-        nightly_archive = get_firefox_download_link()
-        logger.msg("Downloading %s" % nightly_archive)
-        target = download_file(nightly_archive, check_file=False)
-
-        # on macOs we just mount the DMG
-        if platform.system() == "Darwin":
-            cmd = "hdiutil attach -mountpoint /Volumes/Nightly %s"
-            os.system(cmd % target)
-            binary = "/Volumes/Nightly/Firefox Nightly.app/Contents/MacOS/firefox"
-        # on linux we unpack it
-        elif platform.system() == "Linux":
-            cmd = "bunzip2 %s" % target
-            os.system(cmd)
-            cmd = "tar -xvf %s" % target[: -len(".bz2")]
-            os.system(cmd)
-            binary = "firefox/firefox"
-
-        mounted = True
-    else:
-        mounted = False
+_DECOMPRESSORS = {"bz2": bz2.BZ2Decompressor, "xz": lzma.LZMADecompressor}
+
+
+def _decompress(fileobj, factory):
+    decompressor = factory()
+    while True:
+        data = fileobj.read(CHUNK_SIZE)
+        if not data:
+            return
+        # archives can be made of several concatenated streams
+        while data:
+            yield decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            data = decompressor.unused_data
+            decompressor = factory()
+
+
+def unpack_archive(url, target_dir, threaded=True):
+    """Downloads and extracts a .tar.bz2 or .tar.xz archive in one pass.
+
+    Nothing but the extracted members is written to disk. With threaded,
+    decompression runs on its own thread while members are written.
+    """
+    compression = url.split(".")[-1]
+    factory = _DECOMPRESSORS[compression]
+    start = time.time()
+    with span("unpack", url=url.split("/")[-1]) as s, stream_file(url) as stream:
+        if threaded:
+            stream = _StreamReader(_decompress(stream, factory), label="decompress")
+            mode = "r|"
+        else:
+            mode = "r|" + compression
+        try:
+            extract = reporting.task("extract")
+            with tarfile.open(fileobj=stream, mode=mode) as tar, extract as task:
+                for tarinfo in tar:
+                    tar.extract(tarinfo, target_dir)
+                    s.add(bytes=tarinfo.size, files=1)
+                    task.add(files=1, bytes=tarinfo.size)
+        finally:
+            if threaded:
+                stream.close()
+    logger.msg("Unpacked %s in %.1fs" % (url.split("/")[-1], time.time() - start))
+
+
+def get_build_id(url):
+    """Returns the build ID of a nightly archive.
+
+    It's the first line of the .txt file published next to the archive.
+    Falls back to the archive ETag, then to its url.
+    """
+    session = get_session()
+    info = re.sub(r"(\.tar\.bz2|\.dmg)$", ".txt", url)
     try:
+        resp = session.get(info)
+        if resp.status_code == 200 and resp.text.strip():
+            return resp.text.split()[0]
+        resp = session.head(url, allow_redirects=True)
+    except ConnectionError:
+        return url
+    return resp.headers.get("ETag", url).strip('"')
+
+
+@contextlib.contextmanager
+def latest_nightly(binary=None, cache=None):
+    if binary is not None:
         yield binary
-    finally:
-        if mounted:
+        return
+
+    # nightlies are kept unpacked in the artifact cache, one per build
+    if cache is None:
+        cache = ArtifactCache()
+    nightly_archive = get_firefox_download_link()
+    key = "nightly-%s-%s" % (platform.system(), get_build_id(nightly_archive))
+    with cache.open(key) as entry:
+        if entry.complete:
+            logger.msg("Using cached nightly from %s" % entry.path)
+        else:
+            with span("nightly"):
+                # on linux we unpack it while it's downloaded
+                if platform.system() == "Linux":
+                    unpack_archive(nightly_archive, entry.path)
+                else:
+                    logger.msg("Downloading %s" % nightly_archive)
+                    target = os.path.join(entry.path, nightly_archive.split("/")[-1])
+                    download_file(nightly_archive, target, check_file=False)
+                entry.commit()
+
+        # on macOs we just mount the DMG, once per creator process
+        mountpoint = "/Volumes/Nightly-%d" % os.getpid()
+        if platform.system() == "Darwin":
+            dmg = glob.glob(os.path.join(entry.path, "*.dmg"))[0]
+            cmd = "hdiutil attach -mountpoint %s %s"
+            os.system(cmd % (mountpoint, dmg))
+            binary = mountpoint + "/Firefox Nightly.app/Contents/MacOS/firefox"
+        else:
+            binary = os.path.join(entry.path, "firefox", "firefox")
+
+        try:
+            yield binary
+        finally:
             if platform.system() == "Darwin":
                 logger.msg("Unmounting Firefox")
                 time.sleep(10)
-                os.system("hdiutil detach /Volumes/Nightly")
-            elif platform.system() == "Linux":
-                # XXX we should keep it for next time
-                shutil.rmtree("firefox")
+                os.system("hdiutil detach %s" % mountpoint)
@@ -15,5 +15,6 @@ setup(
     entry_points="""
       [console_scripts]
       cp-creator = condprof.creator:main
+      cp-bench = condprof.benchmark:main
       """,
 )